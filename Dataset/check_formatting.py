@@ -0,0 +1,358 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "pipeline"))
+
+from format_dataset import Formatter
+from schema import COL_TYPES, TABLE_COLUMNS
+from storage import STORAGES, get_storage
+
+# Hit objects with every case compute_duration had to handle. A slider's
+# repeats don't change its duration, length is of a single pass.
+FIXTURE = pd.DataFrame(
+    [
+        ("circle", 1000, 0.0, 1, 0, 1.4, 300.0),
+        ("circle", 1200, np.nan, 0, 0, 1.4, 300.0),
+        ("slider", 1500, 70.0, 1, 0, 1.4, 300.0),
+        ("slider", 2000, 140.0, 2, 0, 1.4, 300.0),
+        ("slider", 2500, 105.5, 3, 0, 0.7, 333.333),
+        ("slider", 3000, 1.0, 1, 0, 1.8, 461.538),
+        ("spinner", 3500, 0.0, 0, 5000, 1.4, 300.0),
+        ("spinner", 6000, np.nan, 0, 6000, 1.4, 300.0),
+        ("spinner", 7000, 0.0, 0, 6500, 1.4, 300.0),
+    ],
+    columns=[
+        "type",
+        "time",
+        "length",
+        "repeat",
+        "spinner_time",
+        "slider_velocity",
+        "beat_length",
+    ],
+)
+
+# Rows compute_duration refused with an exception, compute_durations has to
+# refuse them too.
+INVALID = [
+    ("slider", 1500, np.nan, 1, 0, 1.4, 300.0),
+    ("slider", 1500, 70.0, 1, 0, 0.0, 300.0),
+    ("slider", 1500, 70.0, 1, 0, 1.4, np.nan),
+]
+
+
+# format_hit_objects before durations were computed column-wise.
+def compute_duration(row):
+    duration = 0
+    if row["type"] == "slider":
+        duration = row["length"] / (row["slider_velocity"] * 100) * row["beat_length"]
+    elif row["type"] == "spinner":
+        duration = row["spinner_time"] - row["time"]
+    return int(duration)
+
+
+def legacy_durations(beatmap_data):
+    return beatmap_data.apply(compute_duration, axis=1).to_numpy(dtype=np.int64)
+
+
+def raises(function, beatmap_data):
+    try:
+        with np.errstate(all="ignore"):
+            function(beatmap_data)
+    except (ValueError, OverflowError, ZeroDivisionError):
+        return True
+    return False
+
+
+# Formatter.process_song before the hit object index and the column-wise
+# timing attributes, durations and delta times, without the mel spectrogram.
+class LegacyFormatter:
+    def __init__(self, dataset_path):
+        self.beatmaps_df = pd.read_csv(os.path.join(dataset_path, "beatmaps.csv"))
+        self.time_points_df = pd.read_csv(
+            os.path.join(dataset_path, "timing_points.csv")
+        )
+        self.hit_objects_df = pd.read_csv(os.path.join(dataset_path, "hit_objects.csv"))
+        # It filtered on a beatmap_id column the exporter never wrote.
+        self.hit_objects_df["beatmap_id"] = (
+            self.hit_objects_df["id"].str.split("-").str[0].astype(int)
+        )
+
+    def extract_timing_attributes(self, group):
+        beatmap_ids = group["id"].values
+        target_times = group["time"].values
+
+        selected_info = self.beatmaps_df.set_index("id").loc[beatmap_ids]
+        base_velocities = selected_info["slider_multiplier"].values
+        difficulty_ratings = selected_info["difficulty_rating"].values
+        mapper_ids = selected_info["mapper_id"].values
+
+        grouped_timing = self.time_points_df.groupby("id")
+
+        results = []
+        for b_id, t_time, base_vel, diff, mapper in zip(
+            beatmap_ids, target_times, base_velocities, difficulty_ratings, mapper_ids
+        ):
+            tp_group = grouped_timing.get_group(b_id)
+            relevant_tp = tp_group[tp_group["time"] <= t_time]
+
+            uninherited_candidates = relevant_tp[relevant_tp["uninherited"] == 1.0]
+            if not uninherited_candidates.empty:
+                latest_uninherited = uninherited_candidates.loc[
+                    uninherited_candidates["time"].idxmax()
+                ]
+            else:
+                latest_uninherited = tp_group.iloc[0]
+
+            inherited_candidates = relevant_tp[relevant_tp["uninherited"] == 0.0]
+            if not inherited_candidates.empty:
+                latest_inherited = inherited_candidates.loc[
+                    inherited_candidates["time"].idxmax()
+                ]
+            else:
+                latest_inherited = latest_uninherited.copy()
+                latest_inherited["beat_length"] = -100
+
+            rel_sv = max(min(10, -100 / latest_inherited["beat_length"]), 0.1)
+            results.append(
+                {
+                    "beat_length": latest_uninherited["beat_length"],
+                    "meter": latest_uninherited["meter"],
+                    "slider_velocity": base_vel * rel_sv,
+                    "sample_set": latest_inherited["sample_set"],
+                    "volume": latest_inherited["volume"],
+                    "effects": latest_inherited["effects"],
+                    "difficulty_rating": diff,
+                    "mapper_id": mapper,
+                }
+            )
+
+        return pd.DataFrame(results)
+
+    def format_hit_objects(self, song_id):
+        beatmap_data = self.hit_objects_df[
+            self.hit_objects_df["beatmap_id"] == int(song_id)
+        ].copy()
+
+        timing_data = [
+            self.extract_timing_attributes(group)
+            for _, group in beatmap_data.groupby("id")
+        ]
+        timing_df = pd.concat(timing_data, ignore_index=True)
+
+        beatmap_data.reset_index(drop=True, inplace=True)
+        beatmap_data = pd.concat([beatmap_data, timing_df], axis=1)
+
+        beatmap_data["duration"] = legacy_durations(beatmap_data)
+        beatmap_data["delta_time"] = (
+            beatmap_data.groupby("id")["time"].diff().fillna(0).astype(int)
+        )
+
+        beatmap_data.drop(columns="length", inplace=True)
+        return beatmap_data[COL_TYPES.keys()].astype(COL_TYPES)
+
+
+# Random hit objects in the formatted table's value ranges.
+def generate_hit_objects(rows, rng):
+    types = rng.choice(["circle", "slider", "spinner"], rows, p=[0.6, 0.39, 0.01])
+    times = rng.integers(0, 600_000, rows)
+    is_slider = types == "slider"
+    return pd.DataFrame(
+        {
+            "type": pd.Categorical(types),
+            "time": times,
+            "length": np.where(
+                is_slider,
+                rng.uniform(1, 600, rows).round(2),
+                rng.choice([0, np.nan], rows),
+            ),
+            "repeat": np.where(is_slider, rng.integers(1, 5, rows), 0),
+            "spinner_time": np.where(
+                types == "spinner", times + rng.integers(0, 5000, rows), 0
+            ),
+            "slider_velocity": rng.choice([0.5, 1.0, 1.4, 1.8, 2.6], rows),
+            "beat_length": rng.choice([300.0, 333.333, 461.538, 1000 / 3], rows),
+        }
+    )
+
+
+# A generated dataset's tables. Difficulties have hit objects before their
+# first timing point, timing points sharing a time, and some have no inherited
+# timing points at all.
+def generate_dataset(folder, beatmapsets, difficulties=3, objects=300, seed=0):
+    rng = np.random.default_rng(seed)
+    beatmaps, timing_points, hit_objects = [], [], []
+    for beatmapset_id in range(1000, 1000 + beatmapsets):
+        os.makedirs(os.path.join(folder, "audio", str(beatmapset_id)))
+        for difficulty in range(difficulties):
+            id = f"{beatmapset_id}-{difficulty}"
+            beatmaps.append(
+                {
+                    "id": id,
+                    "slider_multiplier": rng.choice([1.0, 1.4, 1.55, 1.8]),
+                    "difficulty_rating": round(rng.uniform(1, 7), 2),
+                    "mapper_id": rng.integers(1, 30_000_000),
+                }
+            )
+
+            points = rng.integers(2, 12)
+            uninherited = rng.random(points) < (0.3 if difficulty else 1.0)
+            uninherited[0] = True
+            point_times = np.sort(rng.integers(500, 120_000, points))
+            point_times[rng.random(points) < 0.2] = point_times[0]
+            timing_points.append(
+                pd.DataFrame(
+                    {
+                        "id": id,
+                        "time": np.sort(point_times),
+                        "beat_length": np.where(
+                            uninherited,
+                            rng.choice([300.0, 333.333333333333, 461.538461538462]),
+                            rng.choice([-50.0, -66.6666666666667, -100.0, -200.0]),
+                        ),
+                        "meter": rng.choice([3, 4], points),
+                        "sample_set": rng.integers(1, 4, points),
+                        "volume": rng.integers(20, 100, points),
+                        "uninherited": uninherited.astype(int),
+                        "effects": rng.choice([0, 1, 8], points),
+                    }
+                )
+            )
+
+            types = rng.choice(
+                ["circle", "slider", "spinner"], objects, p=[0.55, 0.4, 0.05]
+            )
+            times = np.sort(rng.integers(0, 130_000, objects))
+            is_slider = types == "slider"
+            hit_objects.append(
+                pd.DataFrame(
+                    {
+                        "id": id,
+                        "time": times,
+                        "type": types,
+                        "x": rng.integers(0, 512, objects),
+                        "y": rng.integers(0, 384, objects),
+                        "hit_sound": rng.choice([0, 2, 4, 8], objects),
+                        "path": np.where(is_slider, "B|100:200|164:232", "E|"),
+                        "repeat": np.where(is_slider, rng.integers(1, 4, objects), 0),
+                        "length": np.where(
+                            is_slider, rng.uniform(10, 400, objects).round(2), 0
+                        ),
+                        "spinner_time": np.where(
+                            types == "spinner",
+                            times + rng.integers(500, 4000, objects),
+                            0,
+                        ),
+                        "new_combo": rng.random(objects) < 0.15,
+                    }
+                )
+            )
+
+    beatmaps = pd.DataFrame(beatmaps).reindex(
+        columns=[*TABLE_COLUMNS["beatmaps"], "mapper_id", "difficulty_rating"]
+    )
+    return {
+        "beatmaps": beatmaps.assign(status="ranked"),
+        "timing_points": pd.concat(timing_points, ignore_index=True),
+        "hit_objects": pd.concat(hit_objects, ignore_index=True),
+    }
+
+
+def check_durations(name, beatmap_data):
+    start = time.perf_counter()
+    expected = legacy_durations(beatmap_data)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = Formatter.compute_durations(beatmap_data)
+    current_time = time.perf_counter() - start
+
+    mismatches = np.flatnonzero(expected != result)
+    assert not len(mismatches), beatmap_data.iloc[mismatches[:10]].assign(
+        expected=expected[mismatches[:10]], result=result[mismatches[:10]]
+    )
+    print(
+        f"{name}: {len(beatmap_data)} durations match, "
+        f"apply {legacy_time:.3f}s, column-wise {current_time:.3f}s"
+    )
+
+
+# Formats every beatmapset of the generated dataset with both formatters and
+# compares the formatted.csv lines they would append.
+def check_formatted(beatmapsets, storage, folder):
+    with tempfile.TemporaryDirectory(dir=folder) as dataset_path:
+        tables = generate_dataset(dataset_path, beatmapsets)
+        for table, df in tables.items():
+            df.to_csv(os.path.join(dataset_path, f"{table}.csv"), index=False)
+            if storage != "csv":
+                get_storage(storage, dataset_path).write(table, df)
+
+        start = time.perf_counter()
+        legacy = LegacyFormatter(dataset_path)
+        song_ids = sorted(os.listdir(os.path.join(dataset_path, "audio")))
+        expected = [legacy.format_hit_objects(song_id) for song_id in song_ids]
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        formatter = Formatter(dataset_path, storage)
+        result = [formatter.format_hit_objects(song_id) for song_id in song_ids]
+        current_time = time.perf_counter() - start
+
+        rows = 0
+        for song_id, expected_df, result_df in zip(song_ids, expected, result):
+            expected_lines = expected_df.to_csv(index=False).splitlines()
+            result_lines = result_df.to_csv(index=False).splitlines()
+            for line, (a, b) in enumerate(zip(expected_lines, result_lines)):
+                assert a == b, f"{song_id} line {line}:\n{a}\n{b}"
+            assert len(expected_lines) == len(result_lines), song_id
+            rows += len(result_df)
+
+        print(
+            f"formatted ({storage}): {rows} rows of {len(song_ids)} beatmapsets "
+            f"match, legacy {legacy_time:.2f}s, current {current_time:.2f}s"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the formatted hit objects with the row-wise formatter."
+    )
+    parser.add_argument(
+        "--rows", type=int, default=100_000, help="Rows of random hit objects."
+    )
+    parser.add_argument(
+        "--beatmapsets",
+        type=int,
+        default=4,
+        help="Beatmapsets of the generated dataset that is formatted.",
+    )
+    parser.add_argument(
+        "--storage",
+        choices=STORAGES,
+        default="csv",
+        help="Storage format the current formatter reads the dataset from.",
+    )
+    parser.add_argument(
+        "--folder", help="Where the generated dataset is written, defaults to tmp."
+    )
+
+    args = parser.parse_args()
+
+    check_durations("fixture", FIXTURE)
+    for row in INVALID:
+        beatmap_data = pd.DataFrame([row], columns=FIXTURE.columns)
+        assert raises(legacy_durations, beatmap_data), row
+        assert raises(Formatter.compute_durations, beatmap_data), row
+    print(f"invalid: {len(INVALID)} rows raise in both")
+    check_durations("random", generate_hit_objects(args.rows, np.random.default_rng(0)))
+    check_formatted(args.beatmapsets, args.storage, args.folder)
+
+
+if __name__ == "__main__":
+    main()
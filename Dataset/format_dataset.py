@@ -1,123 +1,318 @@
 import argparse
+import hashlib
+import multiprocessing
 import os
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import sys
+from concurrent.futures import ProcessPoolExecutor
 
 import librosa
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
-COL_TYPES = {
-    "id": "string",
-    "time": "float64",
-    "type": "string",
-    "x": "int16",
-    "y": "int16",
-    "hit_sound": "int8",
-    "path": "string",
-    "repeat": "int16",
-    "spinner_time": "int32",
-    "new_combo": "bool",
-    "slider_velocity": "float64",
-    "sample_set": "int8",
-    "volume": "int8",
-    "effects": "int8",
-    "difficulty_rating": "float16",
-    "meter": "int8",
-    "beat_length": "float64",
-    "mapper_id": "int64",
-    "beatmap_id": "int64",
-    "duration": "int64",
-    "delta_time": "int64",
-}
+sys.path.append(os.path.join(os.path.dirname(__file__), "pipeline"))
+
+from audio_manifest import AudioManifest
+from ledger import changed_ids, ingestion_ledger, table_ledger
+from mel_cache import MelCache
+from mel_store import MelStore
+from schema import COL_TYPES, get_beatmapset_ids
+from storage import STORAGES, get_storage
+
+MEL_PARAMS = {"sr": 22050, "n_fft": 2048, "hop_length": 512, "n_mels": 128}
+BEATMAP_COLUMNS = ["id", "slider_multiplier", "difficulty_rating", "mapper_id"]
+
+# Formatter shared with the worker processes, see Formatter.process_songs.
+formatter = None
+
+
+def init_worker(shared_formatter):
+    global formatter
+    formatter = shared_formatter
+
+
+def format_song(song):
+    song_id, song_path = song
+    return song_id, *formatter.process_song(song_id, song_path)
 
 
 class Formatter:
-    def __init__(self, dataset_path):
+    def __init__(
+        self,
+        dataset_path,
+        storage="csv",
+        mel_cache_folder=None,
+        mel_cache_size=20 * 1024**3,
+    ):
         self.dataset_path = dataset_path
+        self.storage = get_storage(storage, dataset_path)
+        self.mel_cache = None
+        if mel_cache_folder:
+            self.mel_cache = MelCache(mel_cache_folder, mel_cache_size)
 
-        self.beatmaps_df = pd.read_csv(os.path.join(dataset_path, "beatmaps.csv"))
-        self.time_points_df = pd.read_csv(
-            os.path.join(dataset_path, "timing_points.csv")
-        )
-        self.hit_objects_df = pd.read_csv(os.path.join(dataset_path, "hit_objects.csv"))
-
+        self.formatted_table = os.path.join("formatted", "formatted")
         self.mel_folder, self.checkpoint_file = self.setup_output_paths()
+        self.mel_store = MelStore(self.mel_folder)
         self.audio_path = os.path.join(dataset_path, "audio")
 
+        # Only the beatmapsets that still have to be formatted are loaded.
+        self.ledger = table_ledger(self.storage, self.formatted_table)
+        self.ingested = ingestion_ledger(dataset_path).hashes(status="done")
+        self.song_ids = self.pending_song_ids()
+
+        self.beatmaps_df = self.storage.read(
+            "beatmaps",
+            columns=BEATMAP_COLUMNS,
+            beatmapset_ids=self.song_ids,
+            typed=True,
+        )
+        self.time_points_df = self.storage.read(
+            "timing_points", beatmapset_ids=self.song_ids, typed=True
+        )
+        self.hit_objects_df = self.storage.read(
+            "hit_objects", beatmapset_ids=self.song_ids, typed=True
+        )
+        self.index_timing_points()
+
+        self.hit_objects_index_file = os.path.join(
+            dataset_path, "formatted", "hit_objects_index.npz"
+        )
+        self.index_hit_objects()
+
     def setup_output_paths(self):
         mel_folder = os.path.join(self.dataset_path, "formatted", "mels")
         os.makedirs(mel_folder, exist_ok=True)
 
-        checkpoint_file = os.path.join(self.dataset_path, "formatted", "formatted.csv")
-        if not os.path.exists(checkpoint_file):
-            pd.DataFrame(columns=COL_TYPES.keys()).to_csv(checkpoint_file, index=False)
+        if not self.storage.exists(self.formatted_table):
+            self.storage.write(
+                self.formatted_table, pd.DataFrame(columns=COL_TYPES.keys())
+            )
+        checkpoint_file = self.storage.path(self.formatted_table)
 
         return mel_folder, checkpoint_file
 
-    def extract_timing_attributes(self, group):
-        beatmap_ids = group["id"].values
-        target_times = group["time"].values
+    def pending_song_ids(self):
+        processed_ids = self.get_already_processed_ids()
+        song_ids = os.listdir(self.audio_path)
+        bad_ids = AudioManifest(self.dataset_path).bad_ids(song_ids)
+
+        # Songs formatted before the ledger existed are taken as up to date.
+        self.ledger.update(
+            [
+                {"beatmapset_id": song_id, "sha256": self.ingested.get(song_id, "")}
+                for song_id in processed_ids
+                if not (self.ledger.get(song_id) or {}).get("sha256")
+                and song_id in self.ingested
+            ]
+        )
+        self.ledger.compact()
+
+        # Songs ingested again since they were formatted lose their rows and
+        # are formatted from scratch.
+        changed = processed_ids & changed_ids(self.ingested, self.ledger.hashes())
+        self.storage.remove(self.formatted_table, changed)
+
+        return [
+            song_id
+            for song_id in song_ids
+            if (song_id not in processed_ids or song_id in changed)
+            and song_id not in bad_ids
+        ]
+
+    def hit_objects_fingerprint(self):
+        # Changes whenever a file of the hit_objects table is written, added or
+        # removed. Which songs are pending doesn't matter, the index covers the
+        # whole table.
+        path = self.storage.path("hit_objects")
+        files = [path]
+        if os.path.isdir(path):
+            files = sorted(
+                os.path.join(root, file)
+                for root, _, folder_files in os.walk(path)
+                for file in folder_files
+            )
+        digest = hashlib.sha256()
+        for file in files:
+            stat = os.stat(file)
+            relative_path = os.path.relpath(file, path)
+            digest.update(
+                f"{relative_path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode()
+            )
+        return np.array(digest.hexdigest())
+
+    def hit_object_runs(self):
+        # Runs of consecutive rows of one beatmapset over the whole table, in
+        # the order the storage reads it, as (beatmapset ids, row counts).
+        keys, counts = [], []
+        for chunk in self.storage.iter_chunks("hit_objects", columns=["id"]):
+            ids = get_beatmapset_ids(chunk, "hit_objects").astype(np.int64).to_numpy()
+            if not len(ids):
+                continue
+            starts = np.flatnonzero(np.diff(ids, prepend=ids[0] - 1))
+            run_counts = np.diff(np.append(starts, len(ids))).tolist()
+            run_keys = ids[starts].tolist()
+            if keys and keys[-1] == run_keys[0]:
+                counts[-1] += run_counts.pop(0)
+                run_keys.pop(0)
+            keys += run_keys
+            counts += run_counts
+        return np.array(keys, dtype=np.int64), np.array(counts, dtype=np.int64)
+
+    def index_hit_objects(self):
+        # Sorts hit objects by beatmapset, keeping the file order inside each
+        # one, so a song's objects are the slice offsets[i]:offsets[i + 1].
+        # The table's runs of beatmapsets are kept next to formatted.csv and
+        # reused while hit_objects is unchanged. The loaded pending songs are
+        # their runs back to back.
+        fingerprint = self.hit_objects_fingerprint()
+        song_ids = np.array([int(song_id) for song_id in self.song_ids], dtype=np.int64)
+
+        runs = None
+        if os.path.exists(self.hit_objects_index_file):
+            index = np.load(self.hit_objects_index_file)
+            if np.array_equal(index["fingerprint"], fingerprint):
+                runs = index["run_keys"], index["run_counts"]
+                # Rows the index doesn't account for mean it's stale after all.
+                pending = np.isin(runs[0], song_ids)
+                if runs[1][pending].sum() != len(self.hit_objects_df):
+                    runs = None
+
+        if runs is None:
+            runs = self.hit_object_runs()
+            np.savez(
+                self.hit_objects_index_file,
+                fingerprint=fingerprint,
+                run_keys=runs[0],
+                run_counts=runs[1],
+            )
+
+        run_keys, run_counts = runs
+        pending = np.isin(run_keys, song_ids)
+        keys, counts = run_keys[pending], run_counts[pending]
+        if counts.sum() != len(self.hit_objects_df):
+            raise ValueError("hit_objects changed while it was being indexed.")
+        starts = np.cumsum(counts) - counts
+
+        # Runs sorted by beatmapset, and where each one lands once sorted.
+        run_order = np.argsort(keys, kind="stable")
+        sorted_counts = counts[run_order]
+        sorted_starts = np.cumsum(sorted_counts) - sorted_counts
+        order = (
+            np.arange(sorted_counts.sum())
+            - np.repeat(sorted_starts, sorted_counts)
+            + np.repeat(starts[run_order], sorted_counts)
+        )
+        keys, first_runs = np.unique(keys[run_order], return_index=True)
+        offsets = np.append(sorted_starts[first_runs], len(order))
+
+        self.hit_objects_df = self.hit_objects_df.iloc[order].reset_index(drop=True)
+        self.hit_object_ranges = {
+            key: (start, end)
+            for key, start, end in zip(keys.tolist(), offsets[:-1], offsets[1:])
+        }
+
+    def index_timing_points(self):
+        self.beatmaps_info = self.beatmaps_df.set_index("id")
+        self.timing_positions = self.time_points_df.groupby(
+            "id", sort=False, observed=True
+        ).indices
+        self.timing_times = self.time_points_df["time"].to_numpy(dtype="float64")
+        self.timing_uninherited = self.time_points_df["uninherited"].to_numpy(
+            dtype="float64", na_value=np.nan
+        )
+
+    def latest_timing_points(self, positions, target_times):
+        # Position of the latest timing point at or before each target time,
+        # the first one in file order on ties, -1 if there is none.
+        if not len(positions):
+            return np.full(len(target_times), -1)
+
+        positions = positions[np.argsort(self.timing_times[positions], kind="stable")]
+        times = self.timing_times[positions]
+
+        latest = np.searchsorted(times, target_times, side="right") - 1
+        found = latest >= 0
+        latest = np.searchsorted(times, times[np.maximum(latest, 0)], side="left")
+        return np.where(found, positions[latest], -1)
 
-        selected_info = self.beatmaps_df.set_index("id").loc[beatmap_ids]
+    def extract_timing_attributes(self, beatmap_data):
+        beatmap_ids = beatmap_data["id"].values
+        target_times = beatmap_data["time"].to_numpy(dtype="float64")
+
+        selected_info = self.beatmaps_info.loc[beatmap_ids]
         base_velocities = selected_info["slider_multiplier"].values
         difficulty_ratings = selected_info["difficulty_rating"].values
         mapper_ids = selected_info["mapper_id"].values
 
-        grouped_timing = self.time_points_df.groupby("id")
+        uninherited_rows = np.empty(len(beatmap_data), dtype=np.int64)
+        inherited_rows = np.empty(len(beatmap_data), dtype=np.int64)
+        for b_id, rows in beatmap_data.groupby(
+            "id", sort=False, observed=True
+        ).indices.items():
+            positions = self.timing_positions[b_id]
+            uninherited = self.timing_uninherited[positions]
 
-        results = []
-        for b_id, t_time, base_vel, diff, mapper in zip(
-            beatmap_ids, target_times, base_velocities, difficulty_ratings, mapper_ids
-        ):
-            tp_group = grouped_timing.get_group(b_id)
-            relevant_tp = tp_group[tp_group["time"] <= t_time]
-
-            uninherited_candidates = relevant_tp[relevant_tp["uninherited"] == 1.0]
-            if not uninherited_candidates.empty:
-                latest_uninherited = uninherited_candidates.loc[
-                    uninherited_candidates["time"].idxmax()
-                ]
-            else:
-                latest_uninherited = tp_group.iloc[0]
-
-            inherited_candidates = relevant_tp[relevant_tp["uninherited"] == 0.0]
-            if not inherited_candidates.empty:
-                latest_inherited = inherited_candidates.loc[
-                    inherited_candidates["time"].idxmax()
-                ]
-            else:
-                latest_inherited = latest_uninherited.copy()
-                latest_inherited["beat_length"] = -100
-
-            beat_length = latest_uninherited["beat_length"]
-            meter = latest_uninherited["meter"]
-            rel_sv = max(min(10, -100 / latest_inherited["beat_length"]), 0.1)
-            slider_velocity = base_vel * rel_sv
-            sample_set = latest_inherited["sample_set"]
-            volume = latest_inherited["volume"]
-            effects = latest_inherited["effects"]
-
-            results.append(
-                {
-                    "beat_length": beat_length,
-                    "meter": meter,
-                    "slider_velocity": slider_velocity,
-                    "sample_set": sample_set,
-                    "volume": volume,
-                    "effects": effects,
-                    "difficulty_rating": diff,
-                    "mapper_id": mapper,
-                }
+            latest_uninherited = self.latest_timing_points(
+                positions[uninherited == 1.0], target_times[rows]
+            )
+            uninherited_rows[rows] = np.where(
+                latest_uninherited >= 0, latest_uninherited, positions[0]
+            )
+            inherited_rows[rows] = self.latest_timing_points(
+                positions[uninherited == 0.0], target_times[rows]
             )
-        return pd.DataFrame(results)
 
-    def save_mel_spectrogram(self, song_id, song_path, chunk_size=512):
-        y, sr = librosa.load(song_path, sr=22050)
+        # Without an inherited timing point the uninherited one is used
+        # with a neutral -100 beat length.
+        has_inherited = inherited_rows >= 0
+        inherited_rows = np.where(has_inherited, inherited_rows, uninherited_rows)
+
+        timing = self.time_points_df
+        inherited_beat_length = np.where(
+            has_inherited, timing["beat_length"].values[inherited_rows], -100
+        )
+        with np.errstate(divide="ignore"):
+            rel_sv = -100 / inherited_beat_length
+        rel_sv = np.where(rel_sv < 10, rel_sv, 10)
+        rel_sv = np.where(0.1 > rel_sv, 0.1, rel_sv)
+
+        return pd.DataFrame(
+            {
+                "beat_length": timing["beat_length"].values[uninherited_rows],
+                "meter": timing["meter"].values[uninherited_rows],
+                "slider_velocity": base_velocities * rel_sv,
+                "sample_set": timing["sample_set"].values[inherited_rows],
+                "volume": timing["volume"].values[inherited_rows],
+                "effects": timing["effects"].values[inherited_rows],
+                "difficulty_rating": difficulty_ratings,
+                "mapper_id": mapper_ids,
+            }
+        )
+
+    def compute_log_mel_spectrogram(self, song_path):
+        y, sr = librosa.load(song_path, sr=MEL_PARAMS["sr"])
         mel_spec = librosa.feature.melspectrogram(
-            y=y, sr=sr, n_fft=2048, hop_length=512, n_mels=128
+            y=y,
+            sr=sr,
+            n_fft=MEL_PARAMS["n_fft"],
+            hop_length=MEL_PARAMS["hop_length"],
+            n_mels=MEL_PARAMS["n_mels"],
         )
-        log_mel_spec = librosa.power_to_db(mel_spec, ref=np.max)
+        return librosa.power_to_db(mel_spec, ref=np.max)
+
+    def load_log_mel_spectrogram(self, song_path):
+        if self.mel_cache is None:
+            return self.compute_log_mel_spectrogram(song_path)
+
+        key = self.mel_cache.key(song_path, MEL_PARAMS)
+        log_mel_spec = self.mel_cache.get(key)
+        if log_mel_spec is None:
+            log_mel_spec = self.compute_log_mel_spectrogram(song_path)
+            self.mel_cache.put(key, log_mel_spec)
+        return log_mel_spec
+
+    def extract_mel_spectrogram(self, song_path, chunk_size=512):
+        log_mel_spec = self.load_log_mel_spectrogram(song_path)
 
         log_mel_spec = log_mel_spec.T
 
@@ -134,41 +329,29 @@ class Formatter:
 
             chunks.append(chunk)
 
-        # np.save(os.path.join(self.mel_folder, f"{song_id}.npy"), np.array(chunks))
-        for idx, c in enumerate(chunks):
-            np.save(os.path.join(self.mel_folder, f"{song_id}_{idx}.npy"), c)
-
-        # print(f"Saved {len(chunks)} chunks for song {song_id}")
+        return np.array(chunks)
 
     def process_song(self, song_id, song_path):
-        self.save_mel_spectrogram(song_id, song_path)
+        mel_chunks = self.extract_mel_spectrogram(song_path)
+        beatmap_data = self.format_hit_objects(song_id)
+        return mel_chunks, beatmap_data
 
-        beatmap_data = self.hit_objects_df[
-            self.hit_objects_df["beatmap_id"] == int(song_id)
-        ].copy()
-
-        timing_data = [
-            self.extract_timing_attributes(group)
-            for _, group in beatmap_data.groupby("id")
-        ]
-        timing_df = pd.concat(timing_data, ignore_index=True)
+    def format_hit_objects(self, song_id):
+        start, end = self.hit_object_ranges.get(int(song_id), (0, 0))
+        beatmap_data = self.hit_objects_df.iloc[start:end].copy()
+        beatmap_data["beatmap_id"] = int(song_id)
 
         beatmap_data.reset_index(drop=True, inplace=True)
-        beatmap_data = pd.concat([beatmap_data, timing_df], axis=1)
-
-        def compute_duration(row):
-            duration = 0
-            if row["type"] == "slider":
-                duration = (
-                    row["length"] / (row["slider_velocity"] * 100) * row["beat_length"]
-                )
-            elif row["type"] == "spinner":
-                duration = row["spinner_time"] - row["time"]
-            return int(duration)
-
-        beatmap_data["duration"] = beatmap_data.apply(compute_duration, axis=1)
+        beatmap_data = beatmap_data.assign(
+            **self.extract_timing_attributes(beatmap_data)
+        )
+
+        beatmap_data["duration"] = self.compute_durations(beatmap_data)
         beatmap_data["delta_time"] = (
-            beatmap_data.groupby("id")["time"].diff().fillna(0).astype(int)
+            beatmap_data.groupby("id", observed=True)["time"]
+            .diff()
+            .fillna(0)
+            .astype(int)
         )
 
         beatmap_data.drop(columns="length", inplace=True)
@@ -176,29 +359,81 @@ class Formatter:
 
         return beatmap_data
 
-    def format_dataset(self):
-        processed_ids = self.get_already_processed_ids()
+    @staticmethod
+    def compute_durations(beatmap_data):
+        # Sliders last length / (slider_velocity * 100) beats, spinners until
+        # their end time, circles 0. Truncated towards zero like int().
+        hit_type = beatmap_data["type"]
+        is_slider = (hit_type == "slider").to_numpy(dtype=bool, na_value=False)
+        is_spinner = (hit_type == "spinner").to_numpy(dtype=bool, na_value=False)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slider_durations = (
+                beatmap_data["length"].to_numpy(dtype="float64")
+                / (beatmap_data["slider_velocity"].to_numpy(dtype="float64") * 100)
+                * beatmap_data["beat_length"].to_numpy(dtype="float64")
+            )
+        times = beatmap_data["time"].to_numpy(dtype="float64")
+        spinner_ends = beatmap_data["spinner_time"].to_numpy(dtype="float64")
+        spinner_durations = spinner_ends - times
+
+        durations = np.select(
+            [is_slider, is_spinner], [slider_durations, spinner_durations], 0
+        )
+        # int() refused these before, they would turn into garbage integers.
+        if not np.isfinite(durations).all():
+            raise ValueError(
+                "Hit object durations aren't finite, a slider or spinner is "
+                "missing its length, slider velocity or end time."
+            )
+        return np.trunc(durations).astype(np.int64)
 
+    def format_dataset(self, workers=1):
         song_paths = {
             song_id: os.path.join(
                 self.audio_path,
                 song_id,
                 os.listdir(os.path.join(self.audio_path, song_id))[0],
             )
-            for song_id in os.listdir(self.audio_path)
-            if song_id not in processed_ids
+            for song_id in self.song_ids
         }
 
-        for song_id, path in tqdm(
-            song_paths.items(), total=len(song_paths), desc="Processing songs"
+        for song_id, mel_chunks, df in tqdm(
+            self.process_songs(song_paths, workers),
+            total=len(song_paths),
+            desc="Processing songs",
         ):
-            df = self.process_song(song_id, path)
-            df.to_csv(self.checkpoint_file, mode="a", header=False, index=False)
+            self.mel_store.append(song_id, mel_chunks)
+            self.storage.append(self.formatted_table, df)
+            self.ledger.update(
+                [{"beatmapset_id": song_id, "sha256": self.ingested.get(song_id, "")}]
+            )
+
+    def process_songs(self, song_paths, workers):
+        # Songs are yielded in order so the checkpoint and the mel store only
+        # ever contain a prefix of song_paths. Workers get this formatter through the
+        # initializer; with fork it is inherited instead of pickled, so the
+        # dataframes are shared copy-on-write.
+        if workers > 1:
+            context = None
+            if "fork" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("fork")
+
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=context,
+                initializer=init_worker,
+                initargs=(self,),
+            ) as executor:
+                yield from executor.map(format_song, song_paths.items())
+        else:
+            for song_id, path in song_paths.items():
+                yield song_id, *self.process_song(song_id, path)
 
     def get_already_processed_ids(self):
         processed_ids = set()
-        for chunk in pd.read_csv(
-            self.checkpoint_file, usecols=["beatmap_id"], chunksize=500_000
+        for chunk in self.storage.iter_chunks(
+            self.formatted_table, columns=["beatmap_id"], chunksize=500_000
         ):
             processed_ids.update(str(bid) for bid in chunk["beatmap_id"].unique())
         return processed_ids
@@ -211,10 +446,38 @@ def main():
     parser.add_argument(
         "--dataset_path", required=True, help="Path to dataset root folder."
     )
+    parser.add_argument(
+        "--storage",
+        choices=STORAGES,
+        default="csv",
+        help="Storage format of the dataset tables.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes formatting songs in parallel.",
+    )
+    parser.add_argument(
+        "--mel_cache",
+        help="Folder caching mel spectrograms by audio content, can be shared "
+        "between datasets.",
+    )
+    parser.add_argument(
+        "--mel_cache_size",
+        type=float,
+        default=20,
+        help="Size limit of the mel cache in GB.",
+    )
     args = parser.parse_args()
 
-    formatter = Formatter(args.dataset_path)
-    formatter.format_dataset()
+    formatter = Formatter(
+        args.dataset_path,
+        args.storage,
+        args.mel_cache,
+        int(args.mel_cache_size * 1024**3),
+    )
+    formatter.format_dataset(args.workers)
 
 
 if __name__ == "__main__":
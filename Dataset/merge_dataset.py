@@ -1,20 +1,40 @@
 import argparse
 import os
 import shutil
+import sys
 
 import pandas as pd
 
+sys.path.append(os.path.join(os.path.dirname(__file__), "pipeline"))
 
-def merge_datasets(folder_one, folder_two, output_folder):
-    df_one = pd.read_csv(os.path.join(folder_one, "encoded.csv"))
-    df_two = pd.read_csv(os.path.join(folder_two, "encoded.csv"))
+from storage import STORAGES, get_storage
+from token_store import TOKEN_STORE_FOLDER, TokenStore, concat_stores
 
-    df_combined = pd.concat([df_one, df_two], ignore_index=True)
 
+def merge_datasets(folder_one, folder_two, output_folder, storage="csv"):
     output_audio_folder = os.path.join(output_folder, "audio")
     os.makedirs(output_audio_folder, exist_ok=True)
 
-    df_combined.to_csv(os.path.join(output_folder, "encoded.csv"), index=False)
+    storage_one = get_storage(storage, folder_one)
+    storage_two = get_storage(storage, folder_two)
+    if storage_one.exists("encoded") or storage_two.exists("encoded"):
+        df_one = storage_one.read("encoded")
+        df_two = storage_two.read("encoded")
+
+        df_combined = pd.concat([df_one, df_two], ignore_index=True)
+        get_storage(storage, output_folder).write("encoded", df_combined)
+
+    # Binary encodings are concatenated as they are, token ids aren't decoded.
+    stores = [
+        TokenStore(os.path.join(folder, TOKEN_STORE_FOLDER))
+        for folder in [folder_one, folder_two]
+    ]
+    if any(store.exists() for store in stores):
+        if not all(store.exists() for store in stores):
+            raise ValueError("Only one of the datasets has a binary encoding.")
+        concat_stores(
+            stores, TokenStore(os.path.join(output_folder, TOKEN_STORE_FOLDER))
+        )
 
     audio_path_one = os.path.join(folder_one, "audio")
     audio_path_two = os.path.join(folder_two, "audio")
@@ -48,10 +68,15 @@ def main():
         "--output_folder",
         required=True,
     )
+    parser.add_argument(
+        "--storage",
+        choices=STORAGES,
+        default="csv",
+    )
 
     args = parser.parse_args()
 
-    merge_datasets(args.folder_one, args.folder_two, args.output_folder)
+    merge_datasets(args.folder_one, args.folder_two, args.output_folder, args.storage)
 
 
 if __name__ == "__main__":
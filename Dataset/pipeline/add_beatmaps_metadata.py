@@ -1,79 +1,102 @@
 import argparse
 import os
-import time
 
 import pandas as pd
-import requests
 from dotenv import load_dotenv
-from tqdm import tqdm
+
+from metadata_store import MetadataStore
+from osu_api import API_URL, OsuApiClient
+from storage import STORAGES, get_storage
 
 load_dotenv()
 CLIENT_ID = os.getenv("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 
+METADATA_COLUMNS = ["status", "ranked_date", "mapper_id", "difficulty_rating"]
 
-def get_access_token():
-    url = "https://osu.ppy.sh/oauth/token"
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    data = {
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "grant_type": "client_credentials",
-        "scope": "public",
-    }
-
-    response = requests.post(url, headers=headers, data=data)
-    return response.json().get("access_token")
-
-
-def get_beatmapset_metadata(beatmapset_id, access_token):
-    url = f"https://osu.ppy.sh/api/v2/beatmapsets/{beatmapset_id}"
-    headers = {"Authorization": f"Bearer {access_token}", "Accept": "application/json"}
-
-    response = requests.get(url, headers=headers)
-
-    if response.status_code == 200:
-        beatmapset = response.json()
-        ranked_date = beatmapset.get("ranked_date")
-        status = beatmapset.get("status", "Unknown")
-        mapper_id = beatmapset.get("user_id")
-
-        beatmaps = {}
-        for beatmap in beatmapset.get("beatmaps"):
-            beatmaps[beatmap["version"]] = beatmap["difficulty_rating"]
-
-        return (status, ranked_date, mapper_id, beatmaps)
-    else:
-        return f"Error: {response.status_code} - {response.text}"
 
-
-def add_metadata(dataset_folder):
-
-    beatmaps_csv = os.path.join(dataset_folder, "beatmaps.csv")
-    beatmaps_df = pd.read_csv(beatmaps_csv, keep_default_na=False)
+def add_metadata(
+    dataset_folder,
+    storage="csv",
+    api_url=API_URL,
+    concurrency=8,
+    rate_limit=10,
+    metadata_store=None,
+):
+    storage = get_storage(storage, dataset_folder)
+    beatmaps_df = storage.read("beatmaps", keep_default_na=False)
 
     beatmapset_ids = set(beatmaps_df["id"].str.split("-").str[0])
 
-    access_token = get_access_token()
-
-    metadatas = {}
-    for beatmapset_id in tqdm(beatmapset_ids):
-        metadatas[beatmapset_id] = get_beatmapset_metadata(beatmapset_id, access_token)
-        time.sleep(0.2)
-
-    def fill_metadatas(row):
-        beatmapset_id = row["id"].split("-")[0]
-        version = row["version"]
-
-        (status, ranked_date, mapper_id, beatmaps) = metadatas[beatmapset_id]
-        row["status"] = status
-        row["ranked_date"] = ranked_date
-        row["mapper_id"] = mapper_id
-        row["difficulty_rating"] = beatmaps[version]
-        return row
-
-    beatmaps_df = beatmaps_df.apply(fill_metadatas, axis=1)
-    beatmaps_df.to_csv(beatmaps_csv, index=False)
+    metadata_store = MetadataStore(
+        metadata_store or os.path.join(dataset_folder, "metadata.sqlite")
+    )
+    stale_ids = metadata_store.stale_ids(beatmapset_ids)
+    print(f"Fetching {len(stale_ids)} of {len(beatmapset_ids)} beatmapsets.")
+
+    client = OsuApiClient(
+        CLIENT_ID,
+        CLIENT_SECRET,
+        api_url=api_url,
+        concurrency=concurrency,
+        rate_limit=rate_limit,
+    )
+    errors = {}
+    for beatmapset_id, metadata in client.iter_beatmapsets_metadata(stale_ids):
+        if isinstance(metadata, tuple):
+            metadata_store.save(beatmapset_id, metadata)
+        else:
+            errors[beatmapset_id] = metadata
+
+    with metadata_store:
+        metadata_df = metadata_store.frame(beatmapset_ids)
+
+    beatmaps_df, rejects_df = merge_metadata(beatmaps_df, metadata_df, errors)
+    storage.write("beatmaps", beatmaps_df)
+
+    if len(rejects_df):
+        rejects_file = os.path.join(dataset_folder, "metadata_rejects.csv")
+        rejects_df.to_csv(rejects_file, index=False)
+        print(f"{len(rejects_df)} beatmaps without metadata, see {rejects_file}")
+
+
+# Left joins the metadata on (beatmapset_id, version). Beatmaps that don't
+# match keep empty metadata columns and are returned as rejects with the
+# reason, the error response of their beatmapset if fetching it failed.
+def merge_metadata(beatmaps_df, metadata_df, errors):
+    keys = pd.DataFrame(
+        {
+            "beatmapset_id": beatmaps_df["id"].str.split("-").str[0],
+            "version": beatmaps_df["version"].astype(str),
+        }
+    )
+    merged = keys.merge(
+        metadata_df,
+        how="left",
+        on=["beatmapset_id", "version"],
+        validate="many_to_one",
+        indicator=True,
+    )
+    merged.index = beatmaps_df.index
+
+    beatmaps_df = beatmaps_df.copy()
+    for column in METADATA_COLUMNS:
+        beatmaps_df[column] = merged[column]
+    beatmaps_df["mapper_id"] = beatmaps_df["mapper_id"].astype("Int64")
+
+    missing = merged["_merge"] == "left_only"
+    rejects_df = keys[missing].copy()
+    rejects_df.insert(0, "id", beatmaps_df.loc[missing, "id"])
+    rejects_df["reason"] = (
+        rejects_df["beatmapset_id"]
+        .map(errors)
+        .fillna(
+            rejects_df["beatmapset_id"]
+            .isin(set(metadata_df["beatmapset_id"]))
+            .map({True: "Missing version", False: "Missing beatmapset"})
+        )
+    )
+    return beatmaps_df, rejects_df
 
 
 def main():
@@ -83,10 +106,45 @@ def main():
         required=True,
         help="Path to the folder containing dataset folders.",
     )
+    parser.add_argument(
+        "--storage",
+        choices=STORAGES,
+        default="csv",
+        help="Storage format of the dataset tables.",
+    )
+    parser.add_argument(
+        "--api_url",
+        default=API_URL,
+        help="Base url of the osu! API, can point to a local stub server.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Number of requests in flight at once.",
+    )
+    parser.add_argument(
+        "--rate_limit",
+        type=float,
+        default=10,
+        help="Maximum number of requests per second.",
+    )
+    parser.add_argument(
+        "--metadata_store",
+        help="SQLite file caching fetched metadata, defaults to "
+        "metadata.sqlite in the dataset folder.",
+    )
 
     args = parser.parse_args()
 
-    add_metadata(args.dataset_folder)
+    add_metadata(
+        args.dataset_folder,
+        args.storage,
+        args.api_url,
+        args.concurrency,
+        args.rate_limit,
+        args.metadata_store,
+    )
 
 
 if __name__ == "__main__":
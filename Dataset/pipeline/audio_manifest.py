@@ -0,0 +1,99 @@
+import csv
+import hashlib
+import os
+import time
+
+COLUMNS = ["id", "file", "size", "mtime_ns", "sha256", "status", "checked_at"]
+BAD_STATUSES = {"corrupted", "missing"}
+
+
+def file_sha256(path):
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return {
+        "file": os.path.basename(path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": file_sha256(path),
+    }
+
+
+# audio_manifest.csv next to the audio folder, with the last verification
+# result of every song's audio file. A file counts as unchanged while its name
+# and size match and either its mtime or, when it was touched or copied
+# again, its content hash does, so verified files aren't decoded again.
+class AudioManifest:
+    def __init__(self, dataset_folder):
+        self.audio_path = os.path.join(dataset_folder, "audio")
+        self.file = os.path.join(dataset_folder, "audio_manifest.csv")
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.file):
+            return
+        with open(self.file, "r", newline="") as f:
+            for entry in csv.DictReader(f):
+                entry["size"] = int(entry["size"])
+                entry["mtime_ns"] = int(entry["mtime_ns"])
+                self.entries[entry["id"]] = entry
+
+    def save(self):
+        tmp_file = f"{self.file}.tmp"
+        with open(tmp_file, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=COLUMNS)
+            writer.writeheader()
+            writer.writerows(self.entries.values())
+        os.replace(tmp_file, self.file)
+
+    def audio_file(self, song_id):
+        folder_path = os.path.join(self.audio_path, song_id)
+        files = os.listdir(folder_path) if os.path.isdir(folder_path) else []
+        return os.path.join(folder_path, files[0]) if files else None
+
+    # Last status of the song's current audio file, None if it has to be checked.
+    def status(self, song_id):
+        entry = self.entries.get(song_id)
+        file_path = self.audio_file(song_id)
+        if entry is None or file_path is None:
+            return None
+
+        stat = os.stat(file_path)
+        if (
+            entry["file"] != os.path.basename(file_path)
+            or entry["size"] != stat.st_size
+        ):
+            return None
+        if entry["mtime_ns"] != stat.st_mtime_ns:
+            if entry["sha256"] != file_sha256(file_path):
+                return None
+            entry["mtime_ns"] = stat.st_mtime_ns
+        return entry["status"]
+
+    def record(self, song_id, status, fingerprint=None):
+        if fingerprint is None:
+            file_path = self.audio_file(song_id)
+            if file_path is None:
+                self.entries.pop(song_id, None)
+                return
+            fingerprint = file_fingerprint(file_path)
+
+        self.entries[song_id] = {
+            "id": song_id,
+            **fingerprint,
+            "status": status,
+            "checked_at": int(time.time()),
+        }
+
+    # Songs whose current audio file is known not to decode.
+    def bad_ids(self, song_ids=None):
+        song_ids = self.entries.keys() if song_ids is None else song_ids
+        return {
+            song_id
+            for song_id in song_ids
+            if song_id in self.entries and self.status(song_id) in BAD_STATUSES
+        }
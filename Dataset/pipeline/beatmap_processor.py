@@ -1,180 +1,256 @@
+import io
 import os
-import pandas as pd
+import sys
+import zipfile
+from array import array
+
+HIT_OBJECT_TYPES = ("circle", "slider", "spinner")
+CIRCLE, SLIDER, SPINNER = range(len(HIT_OBJECT_TYPES))
+HIT_OBJECT_COLUMNS = [
+    "type",
+    "x",
+    "y",
+    "time",
+    "hit_sound",
+    "path",
+    "repeat",
+    "length",
+    "spinner_time",
+    "new_combo",
+]
+
+
+# Lowercased AudioFilename of an .osu file, empty if it has none.
+def read_audio_filename(lines):
+    audio_filename = ""
+    for line in lines:
+        if line.startswith("AudioFilename"):
+            audio_filename = line.split(":")[1].strip().lower()
+            continue
+    return audio_filename
+
+
+# Whole numbers as the .osu file has them, 70 rather than 70.0.
+def format_number(number):
+    if isinstance(number, float) and number.is_integer():
+        return str(int(number))
+    return repr(number)
+
+
+# Hit objects of a beatmap as parallel typed columns rather than a dict per
+# object. Types are stored as indexes into HIT_OBJECT_TYPES and slider paths
+# are interned. Repeats and lengths of sliders and end times of spinners are
+# parsed from text, which is kept in raw only where the number wouldn't be
+# written back the same, so rows() and to_dicts() give the .osu text.
+class HitObjectColumns:
+    TYPECODES = {
+        "type": "b",
+        "x": "i",
+        "y": "i",
+        "time": "i",
+        "hit_sound": "i",
+        "repeat": "i",
+        "length": "d",
+        "spinner_time": "i",
+        "new_combo": "b",
+    }
+    # Text columns and the type of the objects that have them, the others are 0.
+    TEXT_COLUMNS = {"repeat": SLIDER, "length": SLIDER, "spinner_time": SPINNER}
+
+    def __init__(self, hit_objects=()):
+        columns = list(zip(*hit_objects)) or [()] * len(HIT_OBJECT_COLUMNS)
+        self.raw = {}
+        for name, column in zip(HIT_OBJECT_COLUMNS, columns):
+            typecode = self.TYPECODES.get(name)
+            if name in self.TEXT_COLUMNS:
+                column = self.parse_text_column(name, column)
+            setattr(self, name, array(typecode, column) if typecode else list(column))
+
+    def parse_text_column(self, name, column):
+        parse = float if self.TYPECODES[name] == "d" else int
+        numbers = []
+        for row, value in enumerate(column):
+            if isinstance(value, str):
+                try:
+                    number = parse(value)
+                except ValueError:
+                    number = parse(0)
+                if format_number(number) != value:
+                    self.raw.setdefault(name, {})[row] = value
+                value = number
+            numbers.append(value)
+        return numbers
+
+    def __len__(self):
+        return len(self.time)
+
+    def text(self, name):
+        raw = self.raw.get(name, {})
+        object_type = self.TEXT_COLUMNS[name]
+        return [
+            raw.get(row, format_number(value)) if t == object_type else 0
+            for row, (t, value) in enumerate(zip(self.type, getattr(self, name)))
+        ]
+
+    # Rows in the hit_objects table column order.
+    def rows(self, id):
+        return list(
+            zip(
+                [id] * len(self),
+                self.time,
+                [HIT_OBJECT_TYPES[t] for t in self.type],
+                self.x,
+                self.y,
+                self.hit_sound,
+                self.path,
+                self.text("repeat"),
+                self.text("length"),
+                self.text("spinner_time"),
+                map(bool, self.new_combo),
+            )
+        )
+
+    def to_dicts(self):
+        columns = {name: getattr(self, name) for name in HIT_OBJECT_COLUMNS}
+        columns["type"] = [HIT_OBJECT_TYPES[t] for t in self.type]
+        columns["new_combo"] = map(bool, self.new_combo)
+        for name in self.TEXT_COLUMNS:
+            columns[name] = self.text(name)
+        return [dict(zip(columns, values)) for values in zip(*columns.values())]
 
 
 class BeatmapProcessor:
     def __init__(self, beatmapset_folder, osu_file):
         self.beatmapset_folder = beatmapset_folder
         self.osu_file = osu_file
-        self.is_mode_osu = self.verify_mode()
-        if self.is_mode_osu:
-            self.hit_objects = self.parse_hit_objects()
-            self.timing_points = self.parse_timing_points()
-            self.metadata = self.parse_metadata()
-            self.difficulty = self.parse_difficulty()
-            self.break_points = self.parse_break_points()
-
-    def verify_mode(self):
-        with open(
-            os.path.join(self.beatmapset_folder, self.osu_file), "r", encoding="utf-8"
-        ) as f:
-            lines = f.readlines()
-            for line in lines:
-                if line.startswith("Mode"):
-                    return int(line.split(":")[1]) == 0
-
-    def parse_hit_objects(self):
-        hit_objects = []
-        with open(
-            os.path.join(self.beatmapset_folder, self.osu_file), "r", encoding="utf-8"
-        ) as f:
-            lines = f.readlines()
-
-        in_hit_objects = False
-        for line in lines:
-            line = line.strip()
-            if line == "[HitObjects]":
-                in_hit_objects = True
-                continue
-
-            if in_hit_objects and line:
-                parts = line.split(",")
-                x, y, time, obj_type, hit_sound = map(int, parts[:5])
-                object_data = parts[5:]
-                t = "circle"
-                path = "E|"
-                spinner_time = 0
-                repeat = 0
-                length = 0
-                new_combo = obj_type & 4 != 0
-
-                if obj_type & 1:
-                    t = "circle"
-
-                elif obj_type & 2:
-                    t = "slider"
-                    path = object_data[0]
-                    repeat = object_data[1]
-                    length = object_data[2]
-
-                elif obj_type & 8:
-                    t = "spinner"
-                    spinner_time = object_data[0]
-
-                hit_objects.append(
-                    {
-                        "type": t,
-                        "x": x,
-                        "y": y,
-                        "time": time,
-                        "hit_sound": hit_sound if hit_sound % 2 == 0 else hit_sound - 1,
-                        "path": path,
-                        "repeat": repeat,
-                        "length": length,
-                        "spinner_time": spinner_time,
-                        "new_combo": new_combo,
-                    }
-                )
-
-        return hit_objects
-
-    def parse_timing_points(self):
-        timing_points = []
-        with open(
-            os.path.join(self.beatmapset_folder, self.osu_file), "r", encoding="utf-8"
-        ) as f:
-            lines = f.readlines()
-
-        in_timing_points = False
-        for line in lines:
-            line = line.strip()
-            if line.startswith("["):
-                in_timing_points = line == "[TimingPoints]"
-                continue
-            if in_timing_points and line:
-                parts = line.split(",")
-
-                while len(parts) < 8:
-                    parts.append("")
-
-                timing_points.append(
-                    {
-                        "time": parts[0],
-                        "beat_length": parts[1],
-                        "meter": parts[2],
-                        "sample_set": parts[3],
-                        "volume": parts[5],
-                        "uninherited": parts[6],
-                        "effects": parts[7],
-                    }
-                )
-
-        return timing_points
-
-    def parse_metadata(self):
-        metadata = {}
-        with open(
-            os.path.join(self.beatmapset_folder, self.osu_file), "r", encoding="utf-8"
-        ) as f:
-            lines = f.readlines()
-
-        in_metadata = False
-        for line in lines:
-            line = line.strip()
-            if line.startswith("["):
-                in_metadata = line == "[Metadata]"
-                continue
-            if in_metadata and line:
-                key, value = line.split(":", 1)
-                metadata[key.strip()] = value.strip()
-
-        return metadata
-
-    def parse_difficulty(self):
-        difficulty = {}
-        with open(
-            os.path.join(self.beatmapset_folder, self.osu_file), "r", encoding="utf-8"
-        ) as f:
-            lines = f.readlines()
-
-        in_difficulty = False
-        for line in lines:
-            line = line.strip()
-            if line.startswith("["):
-                in_difficulty = line == "[Difficulty]"
-                continue
-            if in_difficulty and line:
-                key, value = line.split(":", 1)
-                difficulty[key.strip()] = value.strip()
-
-        return difficulty
-
-    def parse_break_points(self):
-        breaks = []
-        with open(
+
+        self.hit_objects = []
+        self.timing_points = []
+        self.metadata = {}
+        self.difficulty = {}
+        self.break_points = []
+        self.in_breaks = False
+
+        self.is_mode_osu = self.parse()
+
+    def open_osu_file(self):
+        # beatmapset_folder is either an extracted folder or an opened .osz.
+        if isinstance(self.beatmapset_folder, zipfile.ZipFile):
+            return io.TextIOWrapper(
+                self.beatmapset_folder.open(self.osu_file), encoding="utf-8"
+            )
+        return open(
             os.path.join(self.beatmapset_folder, self.osu_file), "r", encoding="utf-8"
-        ) as f:
-            lines = f.readlines()
+        )
+
+    def parse(self):
+        # Reads the file once and dispatches every line to the parser of the
+        # section it belongs to. Stops as soon as the mode turns out not to be osu!.
+        section_parsers = {
+            "[HitObjects]": self.parse_hit_object,
+            "[TimingPoints]": self.parse_timing_point,
+            "[Metadata]": self.parse_metadata,
+            "[Difficulty]": self.parse_difficulty,
+            "[Events]": self.parse_event,
+        }
+
+        is_mode_osu = None
+        section_parser = None
+        with self.open_osu_file() as f:
+            for line in f:
+                if is_mode_osu is None and line.startswith("Mode"):
+                    is_mode_osu = int(line.split(":")[1]) == 0
+                    if not is_mode_osu:
+                        break
 
-            in_events = False
-            in_breaks = False
-            for line in lines:
                 line = line.strip()
                 if line.startswith("["):
-                    in_events = line == "[Events]"
+                    section_parser = section_parsers.get(line)
                     continue
-                if in_events and line:
-                    if line.startswith("//"):
-                        in_breaks = line == "//Break Periods"
-                        continue
-                    if in_breaks:
-                        breaks.append(line)
+                if section_parser and line:
+                    section_parser(line)
+
+        self.hit_objects = HitObjectColumns(self.hit_objects)
+        return is_mode_osu
+
+    def parse_hit_object(self, line):
+        parts = line.split(",")
+        x, y, time, obj_type, hit_sound = map(int, parts[:5])
+        object_data = parts[5:]
+        t = CIRCLE
+        path = "E|"
+        spinner_time = 0
+        repeat = 0
+        length = 0
+        new_combo = obj_type & 4 != 0
+
+        if obj_type & 1:
+            t = CIRCLE
+
+        elif obj_type & 2:
+            t = SLIDER
+            path = sys.intern(object_data[0])
+            repeat = object_data[1]
+            length = object_data[2]
+
+        elif obj_type & 8:
+            t = SPINNER
+            spinner_time = object_data[0]
+
+        self.hit_objects.append(
+            (
+                t,
+                x,
+                y,
+                time,
+                hit_sound if hit_sound % 2 == 0 else hit_sound - 1,
+                path,
+                repeat,
+                length,
+                spinner_time,
+                new_combo,
+            )
+        )
+
+    def parse_timing_point(self, line):
+        parts = line.split(",")
+
+        while len(parts) < 8:
+            parts.append("")
+
+        self.timing_points.append(
+            {
+                "time": parts[0],
+                "beat_length": parts[1],
+                "meter": parts[2],
+                "sample_set": parts[3],
+                "volume": parts[5],
+                "uninherited": parts[6],
+                "effects": parts[7],
+            }
+        )
+
+    def parse_metadata(self, line):
+        key, value = line.split(":", 1)
+        self.metadata[key.strip()] = value.strip()
+
+    def parse_difficulty(self, line):
+        key, value = line.split(":", 1)
+        self.difficulty[key.strip()] = value.strip()
 
-            return breaks
+    def parse_event(self, line):
+        if line.startswith("//"):
+            self.in_breaks = line == "//Break Periods"
+        elif self.in_breaks:
+            self.break_points.append(line)
 
-    def get_data(self):
+    # Hit objects come as HitObjectColumns with columnar=True, otherwise as
+    # one dict per object.
+    def get_data(self, columnar=False):
         return {
-            "hit_objects": self.hit_objects,
+            "hit_objects": (
+                self.hit_objects if columnar else self.hit_objects.to_dicts()
+            ),
             "timing_points": self.timing_points,
             "metadata": self.metadata,
             "difficulty": self.difficulty,
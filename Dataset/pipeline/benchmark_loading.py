@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from schema import COL_TYPES
+from storage import get_storage
+
+# Columns Tokenizer/encode.py loads from formatted.csv.
+ENCODED_COLUMNS = [
+    "id",
+    "time",
+    "type",
+    "delta_time",
+    "repeat",
+    "slider_velocity",
+    "duration",
+]
+
+MODES = {
+    "default": {},
+    "typed": {"typed": True},
+    "typed_projected": {"typed": True, "columns": ENCODED_COLUMNS},
+    "typed_c": {"typed": True, "engine": "c"},
+    "typed_projected_c": {"typed": True, "columns": ENCODED_COLUMNS, "engine": "c"},
+}
+
+
+# Synthetic formatted table, beatmaps of ~500 hit objects with plausible values.
+def generate(folder, rows, chunk_rows=1_000_000, seed=0):
+    rng = np.random.default_rng(seed)
+    path = os.path.join(folder, "formatted.csv")
+    written = 0
+    while written < rows:
+        n = min(chunk_rows, rows - written)
+        beatmap = (np.arange(written, written + n) // 500).astype(np.int64)
+        types = rng.choice(["circle", "slider", "spinner"], n, p=[0.6, 0.39, 0.01])
+        df = pd.DataFrame(
+            {
+                "id": [f"{b // 5 + 100000}-{b % 5}" for b in beatmap],
+                "time": rng.integers(0, 600_000, n).astype(np.float64),
+                "type": types,
+                "x": rng.integers(0, 512, n),
+                "y": rng.integers(0, 384, n),
+                "hit_sound": rng.choice([0, 2, 4, 8], n),
+                "path": np.where(types == "slider", "B|100:200|164:232", "E|"),
+                "repeat": rng.integers(0, 3, n),
+                "spinner_time": 0,
+                "new_combo": rng.random(n) < 0.1,
+                "slider_velocity": rng.choice([0.0, 1.4, 1.8, 2.0], n),
+                "sample_set": rng.integers(0, 4, n),
+                "volume": rng.integers(20, 100, n),
+                "effects": 0,
+                "difficulty_rating": rng.random(n).round(2) * 7,
+                "meter": 4,
+                "beat_length": rng.choice([300.0, 333.333, 461.538], n),
+                "mapper_id": rng.integers(1, 30_000_000, n),
+                "beatmap_id": beatmap // 5 + 100000,
+                "duration": rng.integers(0, 2000, n),
+                "delta_time": rng.integers(0, 1000, n),
+            },
+            columns=list(COL_TYPES),
+        )
+        df.to_csv(path, mode="a", header=written == 0, index=False)
+        written += n
+    return path
+
+
+def peak_rss():
+    # VmHWM starts over at exec, ru_maxrss would keep the parent's peak.
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Runs in its own process so the peak is that of this load alone.
+def load(folder, mode):
+    start = time.perf_counter()
+    df = get_storage("csv", folder).read("formatted", **MODES[mode])
+    elapsed = time.perf_counter() - start
+    print(
+        json.dumps(
+            {
+                "seconds": elapsed,
+                "frame_bytes": int(df.memory_usage(deep=True).sum()),
+                "peak_rss_bytes": peak_rss(),
+            }
+        )
+    )
+
+
+def benchmark(rows, folder):
+    with tempfile.TemporaryDirectory(dir=folder) as tmp_folder:
+        start = time.perf_counter()
+        path = generate(tmp_folder, rows)
+        print(
+            f"{rows} rows, {os.path.getsize(path) / 2**20:.0f} MiB csv, "
+            f"generated in {time.perf_counter() - start:.1f}s"
+        )
+
+        for mode in MODES:
+            output = subprocess.run(
+                [sys.executable, __file__, "--load", mode, "--folder", tmp_folder],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            result = json.loads(output.splitlines()[-1])
+            print(
+                f"{mode:18} {result['seconds']:7.2f}s  "
+                f"frame {result['frame_bytes'] / 2**20:8.0f} MiB  "
+                f"peak rss {result['peak_rss_bytes'] / 2**20:8.0f} MiB"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare default and typed loading of a synthetic formatted table."
+    )
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument(
+        "--folder", help="Where the synthetic table is written, defaults to tmp."
+    )
+    parser.add_argument("--load", choices=MODES, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.load:
+        load(args.folder, args.load)
+    else:
+        benchmark(args.rows, args.folder)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+import argparse
+import os
+import time
+
+from beatmap_processor import BeatmapProcessor
+
+
+# Previous BeatmapProcessor that reads the .osu file once per section.
+# Kept only as a reference for the benchmark.
+class LegacyBeatmapProcessor:
+    def __init__(self, beatmapset_folder, osu_file):
+        self.beatmapset_folder = beatmapset_folder
+        self.osu_file = osu_file
+        self.is_mode_osu = self.verify_mode()
+        if self.is_mode_osu:
+            self.hit_objects = self.parse_hit_objects()
+            self.timing_points = self.parse_timing_points()
+            self.metadata = self.parse_metadata()
+            self.difficulty = self.parse_difficulty()
+            self.break_points = self.parse_break_points()
+
+    def verify_mode(self):
+        with open(
+            os.path.join(self.beatmapset_folder, self.osu_file), "r", encoding="utf-8"
+        ) as f:
+            lines = f.readlines()
+            for line in lines:
+                if line.startswith("Mode"):
+                    return int(line.split(":")[1]) == 0
+
+    def parse_hit_objects(self):
+        hit_objects = []
+        with open(
+            os.path.join(self.beatmapset_folder, self.osu_file), "r", encoding="utf-8"
+        ) as f:
+            lines = f.readlines()
+
+        in_hit_objects = False
+        for line in lines:
+            line = line.strip()
+            if line == "[HitObjects]":
+                in_hit_objects = True
+                continue
+
+            if in_hit_objects and line:
+                parts = line.split(",")
+                x, y, time, obj_type, hit_sound = map(int, parts[:5])
+                object_data = parts[5:]
+                t = "circle"
+                path = "E|"
+                spinner_time = 0
+                repeat = 0
+                length = 0
+                new_combo = obj_type & 4 != 0
+
+                if obj_type & 1:
+                    t = "circle"
+
+                elif obj_type & 2:
+                    t = "slider"
+                    path = object_data[0]
+                    repeat = object_data[1]
+                    length = object_data[2]
+
+                elif obj_type & 8:
+                    t = "spinner"
+                    spinner_time = object_data[0]
+
+                hit_objects.append(
+                    {
+                        "type": t,
+                        "x": x,
+                        "y": y,
+                        "time": time,
+                        "hit_sound": hit_sound if hit_sound % 2 == 0 else hit_sound - 1,
+                        "path": path,
+                        "repeat": repeat,
+                        "length": length,
+                        "spinner_time": spinner_time,
+                        "new_combo": new_combo,
+                    }
+                )
+
+        return hit_objects
+
+    def parse_timing_points(self):
+        timing_points = []
+        with open(
+            os.path.join(self.beatmapset_folder, self.osu_file), "r", encoding="utf-8"
+        ) as f:
+            lines = f.readlines()
+
+        in_timing_points = False
+        for line in lines:
+            line = line.strip()
+            if line.startswith("["):
+                in_timing_points = line == "[TimingPoints]"
+                continue
+            if in_timing_points and line:
+                parts = line.split(",")
+
+                while len(parts) < 8:
+                    parts.append("")
+
+                timing_points.append(
+                    {
+                        "time": parts[0],
+                        "beat_length": parts[1],
+                        "meter": parts[2],
+                        "sample_set": parts[3],
+                        "volume": parts[5],
+                        "uninherited": parts[6],
+                        "effects": parts[7],
+                    }
+                )
+
+        return timing_points
+
+    def parse_metadata(self):
+        metadata = {}
+        with open(
+            os.path.join(self.beatmapset_folder, self.osu_file), "r", encoding="utf-8"
+        ) as f:
+            lines = f.readlines()
+
+        in_metadata = False
+        for line in lines:
+            line = line.strip()
+            if line.startswith("["):
+                in_metadata = line == "[Metadata]"
+                continue
+            if in_metadata and line:
+                key, value = line.split(":", 1)
+                metadata[key.strip()] = value.strip()
+
+        return metadata
+
+    def parse_difficulty(self):
+        difficulty = {}
+        with open(
+            os.path.join(self.beatmapset_folder, self.osu_file), "r", encoding="utf-8"
+        ) as f:
+            lines = f.readlines()
+
+        in_difficulty = False
+        for line in lines:
+            line = line.strip()
+            if line.startswith("["):
+                in_difficulty = line == "[Difficulty]"
+                continue
+            if in_difficulty and line:
+                key, value = line.split(":", 1)
+                difficulty[key.strip()] = value.strip()
+
+        return difficulty
+
+    def parse_break_points(self):
+        breaks = []
+        with open(
+            os.path.join(self.beatmapset_folder, self.osu_file), "r", encoding="utf-8"
+        ) as f:
+            lines = f.readlines()
+
+            in_events = False
+            in_breaks = False
+            for line in lines:
+                line = line.strip()
+                if line.startswith("["):
+                    in_events = line == "[Events]"
+                    continue
+                if in_events and line:
+                    if line.startswith("//"):
+                        in_breaks = line == "//Break Periods"
+                        continue
+                    if in_breaks:
+                        breaks.append(line)
+
+            return breaks
+
+    def get_data(self):
+        return {
+            "hit_objects": self.hit_objects,
+            "timing_points": self.timing_points,
+            "metadata": self.metadata,
+            "difficulty": self.difficulty,
+            "break_points": self.break_points,
+        }
+
+
+def collect_osu_files(input_folder):
+    osu_files = []
+    for entry in os.listdir(input_folder):
+        entry_path = os.path.join(input_folder, entry)
+        if not os.path.isdir(entry_path):
+            continue
+        osu_files += [
+            (entry_path, file)
+            for file in os.listdir(entry_path)
+            if file.endswith(".osu")
+        ]
+    return osu_files
+
+
+def run(processor_class, osu_files, repeat):
+    best = float("inf")
+    results = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [processor_class(folder, file) for folder, file in osu_files]
+        best = min(best, time.perf_counter() - start)
+    return best, results
+
+
+def benchmark(input_folder, repeat):
+    osu_files = collect_osu_files(input_folder)
+
+    legacy_time, legacy = run(LegacyBeatmapProcessor, osu_files, repeat)
+    current_time, current = run(BeatmapProcessor, osu_files, repeat)
+
+    for old, new in zip(legacy, current):
+        assert bool(old.is_mode_osu) == bool(new.is_mode_osu), new.osu_file
+        if new.is_mode_osu:
+            assert old.get_data() == new.get_data(), new.osu_file
+
+    print(f"{len(osu_files)} .osu files, best of {repeat}")
+    print(f"LegacyBeatmapProcessor: {legacy_time:.3f}s")
+    print(f"BeatmapProcessor:       {current_time:.3f}s")
+    print(f"Speedup:                {legacy_time / current_time:.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the single pass parser with the legacy one."
+    )
+    parser.add_argument(
+        "--input_folder",
+        required=True,
+        help="Path to the folder containing extracted songs folders.",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+
+    args = parser.parse_args()
+
+    benchmark(args.input_folder, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import argparse
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from osu_api import OsuApiClient
+
+BEATMAPSET = {
+    "status": "ranked",
+    "ranked_date": "2020-01-01T00:00:00Z",
+    "user_id": 123,
+    "beatmaps": [{"version": "Hard", "difficulty_rating": 3.2}],
+}
+
+
+# Local stand-in for the osu! API. Beatmapset ids pick the failure:
+#   1: 429 with Retry-After once, 2: 500 twice, 5: 503 on every request.
+# Tokens are numbered, the first one expires after expire_after requests and
+# gets a 401 from then on. tokens=False answers token requests without one.
+class StubApi(ThreadingHTTPServer):
+    def __init__(self, expire_after=None, tokens=True):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.expire_after = expire_after
+        self.tokens = tokens
+        self.token_requests = 0
+        self.requests = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None, headers=()):
+        data = json.dumps(body or {}).encode()
+        self.send_response(status)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            self.server.token_requests += 1
+            token = f"token{self.server.token_requests}"
+        if not self.server.tokens:
+            return self.reply(401, {"error": "invalid_client"})
+        self.reply(200, {"access_token": token})
+
+    def do_GET(self):
+        beatmapset_id = self.path.rsplit("/", 1)[-1]
+        with self.server.lock:
+            self.server.requests[beatmapset_id] += 1
+            count = self.server.requests[beatmapset_id]
+            total = sum(self.server.requests.values())
+
+        expire_after = self.server.expire_after
+        if (
+            self.headers["Authorization"] == "Bearer token1"
+            and expire_after is not None
+            and total > expire_after
+        ):
+            return self.reply(401)
+        if beatmapset_id == "1" and count == 1:
+            return self.reply(429, headers=[("Retry-After", "0")])
+        if beatmapset_id == "2" and count <= 2:
+            return self.reply(500)
+        if beatmapset_id == "5":
+            return self.reply(503)
+        self.reply(200, BEATMAPSET)
+
+
+def client(api, **kwargs):
+    return OsuApiClient("id", "secret", api_url=api.url, backoff=0.01, **kwargs)
+
+
+def check_retries():
+    with StubApi() as api:
+        results = dict(
+            client(api, concurrency=4, max_retries=3).iter_beatmapsets_metadata(
+                ["1", "2", "3", "5"]
+            )
+        )
+        assert all(isinstance(results[i], tuple) for i in "123"), results
+        assert results["5"].startswith("Error: 503"), results["5"]
+        assert api.requests == {"1": 2, "2": 3, "3": 1, "5": 4}, api.requests
+        print("retries: 429 and 500 retried, 503 given up after 3 retries")
+
+
+def check_token_refresh():
+    # The first token expires while several threads use it, it is refreshed once.
+    with StubApi(expire_after=5) as api:
+        ids = [str(i) for i in range(10, 40)]
+        results = dict(client(api, concurrency=8).iter_beatmapsets_metadata(ids))
+        assert all(isinstance(result, tuple) for result in results.values()), results
+        assert api.token_requests == 2, api.token_requests
+        print(f"token refresh: {len(ids)} beatmapsets, {api.token_requests} tokens")
+
+
+def check_missing_token():
+    with StubApi(tokens=False) as api:
+        api_client = client(api, concurrency=4)
+        for _ in range(2):
+            try:
+                api_client.get("/api/v2/beatmapsets/3")
+            except ValueError as e:
+                error = e
+            else:
+                raise AssertionError("No token should raise.")
+        assert api.token_requests == 1 and not api.requests, api.token_requests
+        print(f"missing token: raised once fetched, {error}")
+
+
+def check_rate_limit(rate_limit):
+    with StubApi() as api:
+        ids = [str(i) for i in range(100, 100 + 3 * rate_limit)]
+        start = time.perf_counter()
+        list(
+            client(api, concurrency=8, rate_limit=rate_limit).iter_beatmapsets_metadata(
+                ids
+            )
+        )
+        elapsed = time.perf_counter() - start
+        # The bucket starts full, the rest come at rate_limit per second.
+        expected = (len(ids) - rate_limit) / rate_limit
+        assert elapsed >= expected * 0.95, elapsed
+        print(
+            f"rate limit: {len(ids)} requests in {elapsed:.2f}s, "
+            f"at least {expected:.2f}s at {rate_limit}/s"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check OsuApiClient's retries, token refresh and rate limit "
+        "against a local stub server."
+    )
+    parser.add_argument("--rate_limit", type=int, default=20)
+
+    args = parser.parse_args()
+
+    check_retries()
+    check_token_refresh()
+    check_missing_token()
+    check_rate_limit(args.rate_limit)
+
+
+if __name__ == "__main__":
+    main()
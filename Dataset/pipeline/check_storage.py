@@ -0,0 +1,113 @@
+import argparse
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from schema import TABLE_COLUMNS
+from storage import PARTITION_COLUMN, get_storage
+
+TABLE = "timing_points"
+
+
+# Timing points of beatmapsets with two difficulties each.
+def generate(beatmapsets, first_id=100000, seed=0):
+    rng = np.random.default_rng(seed)
+    ids = [f"{first_id + i}-{d}" for i in range(beatmapsets) for d in range(2)]
+    rows = len(ids) * 3
+    return pd.DataFrame(
+        {
+            "id": np.repeat(ids, 3),
+            "time": rng.integers(0, 600_000, rows),
+            "beat_length": rng.choice([300.0, 333.333, 461.538, -100.0], rows),
+            "meter": 4,
+            "sample_set": rng.integers(0, 4, rows),
+            "volume": rng.integers(20, 100, rows),
+            "uninherited": rng.integers(0, 2, rows),
+            "effects": 0,
+        },
+        columns=TABLE_COLUMNS[TABLE],
+    )
+
+
+def compare(name, storages, **read_kwargs):
+    csv_df, parquet_df = (
+        storage.read(TABLE, **read_kwargs)
+        .astype({"id": str})
+        .sort_values(["id", "time"], kind="stable")
+        .reset_index(drop=True)
+        for storage in storages
+    )
+    pd.testing.assert_frame_equal(csv_df, parquet_df, check_dtype=False)
+    print(f"{name}: {len(parquet_df)} rows match")
+
+
+def partition_files(storage):
+    path = storage.path(TABLE)
+    return [
+        len(os.listdir(os.path.join(path, folder)))
+        for folder in os.listdir(path)
+        if folder.startswith(f"{PARTITION_COLUMN}=")
+    ]
+
+
+def check(beatmapsets, folder):
+    with tempfile.TemporaryDirectory(dir=folder) as tmp_folder:
+        storages = [
+            get_storage(name, os.path.join(tmp_folder, name))
+            for name in ["csv", "parquet"]
+        ]
+        for storage in storages:
+            os.makedirs(storage.folder)
+        parquet = storages[1]
+
+        df = generate(beatmapsets)
+        for storage in storages:
+            storage.write(TABLE, df)
+        compare("write", storages)
+
+        # The first difficulties again, their partitions get a second file.
+        more = generate(beatmapsets, seed=1)
+        more = more[more["id"].str.endswith("-0")]
+        for storage in storages:
+            storage.append(TABLE, more)
+        compare("append", storages)
+        files = partition_files(parquet)
+        assert len(files) == beatmapsets and set(files) == {1}, set(files)
+        print(f"append: {len(files)} partitions of one file")
+
+        beatmapset_ids = [str(100000 + i) for i in range(0, beatmapsets, 7)]
+        compare("read beatmapsets", storages, beatmapset_ids=beatmapset_ids)
+
+        for storage in storages:
+            storage.remove(TABLE, beatmapset_ids)
+        compare("remove", storages)
+
+        keep_ids = df["id"].drop_duplicates().iloc[::3]
+        for storage in storages:
+            storage.keep_rows(TABLE, keep_ids)
+        compare("keep_rows", storages)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the parquet storage with the csv one on a synthetic table."
+    )
+    parser.add_argument(
+        "--beatmapsets",
+        type=int,
+        default=1500,
+        help="Beatmapsets in the table, pyarrow allows 1024 partitions by default.",
+    )
+    parser.add_argument(
+        "--folder", help="Where the synthetic tables are written, defaults to tmp."
+    )
+
+    args = parser.parse_args()
+
+    check(args.beatmapsets, args.folder)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,134 +1,136 @@
-import csv
 import os
 
+from beatmap_processor import HitObjectColumns
+from schema import TABLE_COLUMNS
+from storage import get_storage
+
 
 class DataExporter:
-    def __init__(self, dataset_folder):
+    def __init__(
+        self, dataset_folder, flush_threshold=100_000, storage="csv", on_flush=None
+    ):
         os.makedirs(dataset_folder, exist_ok=True)
-        self.beatmaps_file = os.path.join(dataset_folder, "beatmaps.csv")
-        self.hit_objects_file = os.path.join(dataset_folder, "hit_objects.csv")
-        self.timing_points_file = os.path.join(dataset_folder, "timing_points.csv")
-
-        self.init_csv()
-
-    def init_csv(self):
-        for file, headers in [
-            (
-                self.beatmaps_file,
-                [
-                    "id",
-                    "title",
-                    "artist",
-                    "creator",
-                    "version",
-                    "hp_drain_rate",
-                    "circle_size",
-                    "overall_difficulty",
-                    "approach_rate",
-                    "slider_multiplier",
-                    "slider_tick_rate",
-                    "break_points",
-                ],
-            ),
-            (
-                self.hit_objects_file,
-                [
-                    "id",
-                    "time",
-                    "type",
-                    "x",
-                    "y",
-                    "hit_sound",
-                    "path",
-                    "repeat",
-                    "length",
-                    "spinner_time",
-                    "new_combo",
-                ],
-            ),
-            (
-                self.timing_points_file,
-                [
-                    "id",
-                    "time",
-                    "beat_length",
-                    "meter",
-                    "sample_set",
-                    "volume",
-                    "uninherited",
-                    "effects",
-                ],
-            ),
-        ]:
-            if not os.path.exists(file):
-                with open(file, "w", newline="", encoding="utf-8") as f:
-                    writer = csv.writer(f)
-                    writer.writerow(headers)
+        self.storage = get_storage(storage, dataset_folder)
+
+        # beatmaps comes last, a beatmapset with a beatmaps row has all of its
+        # rows written.
+        self.tables = ["hit_objects", "timing_points", "beatmaps"]
+        self.flush_threshold = flush_threshold
+        # Called after every flush, once the buffered rows are on disk.
+        self.on_flush = on_flush
+        self.buffers = {table: [] for table in self.tables}
+        self.buffered_rows = 0
+
+        self.init_tables()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def init_tables(self):
+        for table in self.tables:
+            self.storage.init_table(table, TABLE_COLUMNS[table])
 
     def write_data(self, data, id):
+        self.write_rows(self.get_rows(data, id))
+
+    def write_rows(self, rows):
+        # Pass every difficulty of a beatmapset at once, a flush never splits
+        # a beatmapset then.
+        for table, table_rows in rows.items():
+            self.buffers[table] += table_rows
+            self.buffered_rows += len(table_rows)
+
+        if self.buffered_rows >= self.flush_threshold:
+            self.flush()
+
+    def flush(self):
+        for table in self.tables:
+            buffer = self.buffers[table]
+            if not buffer:
+                continue
+
+            self.storage.append_rows(table, buffer)
+            buffer.clear()
+
+        self.buffered_rows = 0
+        if self.on_flush is not None:
+            self.on_flush()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.storage.close()
+
+    @staticmethod
+    def get_rows(data, id):
         hit_objects = data["hit_objects"]
         timing_points = data["timing_points"]
         metadata = data["metadata"]
         difficulty = data["difficulty"]
         break_points = data["break_points"]
 
-        self.save_beatmap(id, metadata, difficulty, break_points)
-        self.save_hit_objects(id, hit_objects)
-        self.save_timing_points(id, timing_points)
-
-    def save_beatmap(self, id, metadata, difficulty, break_points):
-        with open(self.beatmaps_file, "a", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow(
-                [
-                    id,
-                    metadata.get("Title", ""),
-                    metadata.get("Artist", ""),
-                    metadata.get("Creator", ""),
-                    str(metadata.get("Version", "")),
-                    difficulty.get("HPDrainRate", ""),
-                    difficulty.get("CircleSize", ""),
-                    difficulty.get("OverallDifficulty", ""),
-                    difficulty.get("ApproachRate", ""),
-                    difficulty.get("SliderMultiplier", ""),
-                    difficulty.get("SliderTickRate", ""),
-                    break_points,
-                ]
-            )
-
-    def save_hit_objects(self, id, hit_objects):
-        with open(self.hit_objects_file, "a", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            for obj in hit_objects:
-                writer.writerow(
-                    [
-                        id,
-                        obj["time"],
-                        obj["type"],
-                        obj["x"],
-                        obj["y"],
-                        obj["hit_sound"],
-                        obj["path"],
-                        obj["repeat"],
-                        obj["length"],
-                        obj["spinner_time"],
-                        obj["new_combo"],
-                    ]
-                )
-
-    def save_timing_points(self, id, timing_points):
-        with open(self.timing_points_file, "a", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            for tp in timing_points:
-                writer.writerow(
-                    [
-                        id,
-                        tp.get("time"),
-                        tp.get("beat_length"),
-                        tp.get("meter"),
-                        tp.get("sample_set"),
-                        tp.get("volume"),
-                        tp.get("uninherited"),
-                        tp.get("effects"),
-                    ]
-                )
+        return {
+            "beatmaps": [
+                DataExporter.beatmap_row(id, metadata, difficulty, break_points)
+            ],
+            "hit_objects": DataExporter.hit_object_rows(id, hit_objects),
+            "timing_points": DataExporter.timing_point_rows(id, timing_points),
+        }
+
+    @staticmethod
+    def beatmap_row(id, metadata, difficulty, break_points):
+        return [
+            id,
+            metadata.get("Title", ""),
+            metadata.get("Artist", ""),
+            metadata.get("Creator", ""),
+            str(metadata.get("Version", "")),
+            difficulty.get("HPDrainRate", ""),
+            difficulty.get("CircleSize", ""),
+            difficulty.get("OverallDifficulty", ""),
+            difficulty.get("ApproachRate", ""),
+            difficulty.get("SliderMultiplier", ""),
+            difficulty.get("SliderTickRate", ""),
+            break_points,
+        ]
+
+    @staticmethod
+    def hit_object_rows(id, hit_objects):
+        if isinstance(hit_objects, HitObjectColumns):
+            return hit_objects.rows(id)
+        return [
+            [
+                id,
+                obj["time"],
+                obj["type"],
+                obj["x"],
+                obj["y"],
+                obj["hit_sound"],
+                obj["path"],
+                obj["repeat"],
+                obj["length"],
+                obj["spinner_time"],
+                obj["new_combo"],
+            ]
+            for obj in hit_objects
+        ]
+
+    @staticmethod
+    def timing_point_rows(id, timing_points):
+        return [
+            [
+                id,
+                tp.get("time"),
+                tp.get("beat_length"),
+                tp.get("meter"),
+                tp.get("sample_set"),
+                tp.get("volume"),
+                tp.get("uninherited"),
+                tp.get("effects"),
+            ]
+            for tp in timing_points
+        ]
@@ -1,21 +1,65 @@
 import os
+import csv
+import io
 import zipfile
+import zlib
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from tqdm import tqdm
 import shutil
 
+from beatmap_processor import read_audio_filename
 
-def extract_osz(osz_file, output_folder):
+INCLUDES = ["all", "beatmap"]
+
+
+# The .osu files and the audio files they refer to, everything else (videos,
+# storyboards, skins) is left compressed.
+def beatmap_members(zip_ref):
+    names = zip_ref.namelist()
+    osu_files = [name for name in names if name.lower().endswith(".osu")]
+
+    audio_filenames = set()
+    for osu_file in osu_files:
+        with zip_ref.open(osu_file) as f:
+            lines = io.TextIOWrapper(f, encoding="utf-8").readlines()
+        audio_filenames.add(read_audio_filename(lines))
+
+    return osu_files + [name for name in names if name.lower() in audio_filenames]
+
+
+def extract_osz(osz_file, output_folder, include="all"):
     try:
         with zipfile.ZipFile(osz_file, "r") as zip_ref:
-            zip_ref.extractall(output_folder)
-    except zipfile.BadZipFile:
+            members = beatmap_members(zip_ref) if include == "beatmap" else None
+            zip_ref.extractall(output_folder, members)
+    except (zipfile.BadZipFile, zlib.error, UnicodeDecodeError) as e:
         shutil.rmtree(output_folder)
-        print(osz_file, "Skipped. Corrupted .osz file")
-        pass
+        return str(e) or type(e).__name__
+    return None
+
+
+def extract_into(filename, input_folder, output_folder, include):
+    osz_file_path = os.path.join(input_folder, filename)
+    folder_name = os.path.splitext(filename)[0]
+    folder_output_path = os.path.join(output_folder, folder_name)
+
+    if not os.path.exists(folder_output_path):
+        os.makedirs(folder_output_path)
+
+    return extract_osz(osz_file_path, folder_output_path, include)
+
 
+def extract_all(extract, osz_files, workers):
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(extract, osz_files, chunksize=4)
+    else:
+        yield from map(extract, osz_files)
 
-def process_folder(input_folder, output_folder):
+
+def process_folder(input_folder, output_folder, workers=1, include="all"):
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
@@ -26,18 +70,29 @@ def process_folder(input_folder, output_folder):
         and not os.path.exists(os.path.join(output_folder, os.path.splitext(f)[0]))
     ]
 
-    with tqdm(total=len(osz_files), desc="Extracting", unit="file") as pbar:
-        for filename in osz_files:
-            osz_file_path = os.path.join(input_folder, filename)
-            folder_name = os.path.splitext(filename)[0]
-            folder_output_path = os.path.join(output_folder, folder_name)
-
-            if not os.path.exists(folder_output_path):
-                os.makedirs(folder_output_path)
+    extract = partial(
+        extract_into,
+        input_folder=input_folder,
+        output_folder=output_folder,
+        include=include,
+    )
 
-            extract_osz(osz_file_path, folder_output_path)
+    corrupted = []
+    with tqdm(total=len(osz_files), desc="Extracting", unit="file") as pbar:
+        for filename, error in zip(osz_files, extract_all(extract, osz_files, workers)):
+            if error is not None:
+                corrupted.append((filename, error))
             pbar.update(1)
 
+    # Rewritten every run, corrupted archives are retried next time.
+    summary_file = os.path.join(output_folder, "corrupted_osz.csv")
+    with open(summary_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["file", "error"])
+        writer.writerows(corrupted)
+    if corrupted:
+        print(f"Skipped {len(corrupted)} corrupted .osz files, see {summary_file}")
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -50,10 +105,22 @@ def main():
         "--output_folder",
         help="Path to the folder where extracted files will be stored.",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of archives extracted in parallel.",
+    )
+    parser.add_argument(
+        "--include",
+        choices=INCLUDES,
+        default="all",
+        help="all: every member, beatmap: only .osu files and their audio file.",
+    )
 
     args = parser.parse_args()
 
-    process_folder(args.input_folder, args.output_folder)
+    process_folder(args.input_folder, args.output_folder, args.workers, args.include)
 
 
 if __name__ == "__main__":
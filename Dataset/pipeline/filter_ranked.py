@@ -1,19 +1,19 @@
 import argparse
-import os
-import shutil
 
 import pandas as pd
 
+from audio_manifest import AudioManifest
+from prune_audio import prune_audio
+from storage import STORAGES, get_storage
 
-def filter_ranked_maps(dataset_folder, ranked_date, exclude):
 
-    beatmaps_csv = os.path.join(dataset_folder, "beatmaps.csv")
-    hit_objects_csv = os.path.join(dataset_folder, "hit_objects.csv")
-    time_points_csv = os.path.join(dataset_folder, "timing_points.csv")
+def filter_ranked_maps(
+    dataset_folder, ranked_date, exclude, storage="csv", workers=8, dry_run=False
+):
+    storage = get_storage(storage, dataset_folder)
 
-    beatmaps_df = pd.read_csv(beatmaps_csv, parse_dates=["ranked_date"])
-    hit_objects_df = pd.read_csv(hit_objects_csv)
-    time_points_df = pd.read_csv(time_points_csv)
+    beatmaps_df = storage.read("beatmaps")
+    beatmaps_df["ranked_date"] = pd.to_datetime(beatmaps_df["ranked_date"])
 
     beatmaps_df = beatmaps_df[
         (beatmaps_df["status"] == "ranked") | (beatmaps_df["status"] == "approved")
@@ -25,30 +25,29 @@ def filter_ranked_maps(dataset_folder, ranked_date, exclude):
         (beatmaps_df["ranked_date"] > ranked_date)
         & (~beatmaps_df["difficulty_rating"].astype(int).isin(exclude))
     ]
+    # Sets whose audio already failed verification and hasn't changed since.
+    bad_ids = AudioManifest(dataset_folder).bad_ids()
+    filtered_beatmaps_df = filtered_beatmaps_df[
+        ~filtered_beatmaps_df["id"].str.split("-").str[0].isin(bad_ids)
+    ]
     filtered_ids = filtered_beatmaps_df["id"]
 
-    filtered_hit_objects_df = hit_objects_df[hit_objects_df["id"].isin(filtered_ids)]
-    filtered_time_points_df = time_points_df[time_points_df["id"].isin(filtered_ids)]
-
-    filtered_beatmaps_df.to_csv(
-        os.path.join(dataset_folder, "beatmaps.csv"), index=False
-    )
-    filtered_hit_objects_df.to_csv(
-        os.path.join(dataset_folder, "hit_objects.csv"), index=False
-    )
-    filtered_time_points_df.to_csv(
-        os.path.join(dataset_folder, "timing_points.csv"), index=False
+    if dry_run:
+        print(f"Would keep {len(filtered_ids)} beatmaps.")
+    else:
+        # The big tables are filtered as a stream into a copy that replaces
+        # them, they are never loaded whole.
+        storage.write("beatmaps", filtered_beatmaps_df)
+        storage.keep_rows("hit_objects", filtered_ids)
+        storage.keep_rows("timing_points", filtered_ids)
+
+    prune_audio(
+        dataset_folder,
+        keep_ids=filtered_ids.str.split("-").str[0],
+        workers=workers,
+        dry_run=dry_run,
     )
 
-    audio_folder = os.path.join(dataset_folder, "audio")
-
-    removed = []
-    for folder in os.listdir(audio_folder):
-        if folder not in set([id.split("-")[0] for id in filtered_ids]):
-            shutil.rmtree(os.path.join(audio_folder, folder))
-            removed.append(folder)
-    print(f"Removed {len(removed)} audio file.")
-
 
 def main():
     parser = argparse.ArgumentParser(description="Filter ranked maps.")
@@ -63,10 +62,34 @@ def main():
     parser.add_argument(
         "--excluded_diffs", required=False, default="0,1,7,8,9,10,11,12"
     )
+    parser.add_argument(
+        "--storage",
+        choices=STORAGES,
+        default="csv",
+        help="Storage format of the dataset tables.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of audio folders deleted at once.",
+    )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="Only report what would be kept and the audio bytes reclaimed.",
+    )
 
     args = parser.parse_args()
 
-    filter_ranked_maps(args.dataset_folder, args.min_ranked_date, args.excluded_diffs)
+    filter_ranked_maps(
+        args.dataset_folder,
+        args.min_ranked_date,
+        args.excluded_diffs,
+        args.storage,
+        args.workers,
+        args.dry_run,
+    )
 
 
 if __name__ == "__main__":
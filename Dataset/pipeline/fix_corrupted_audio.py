@@ -1,137 +1,157 @@
 import os
 import argparse
-from tqdm import tqdm
-import pandas as pd
-import shutil
+import json
 import subprocess
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from tqdm import tqdm
 
+from audio_manifest import BAD_STATUSES, AudioManifest, file_fingerprint
+from prune_audio import prune_audio
+from storage import STORAGES, get_storage
 
-def remove_rows_by_ids(dataset_folder, ids_to_remove):
-    beatmaps_csv = os.path.join(dataset_folder, "beatmaps.csv")
-    hit_objects_csv = os.path.join(dataset_folder, "hit_objects.csv")
-    time_points_csv = os.path.join(dataset_folder, "timing_points.csv")
-
-    beatmaps_df = pd.read_csv(beatmaps_csv)
-    hit_objects_df = pd.read_csv(hit_objects_csv)
-    time_points_df = pd.read_csv(time_points_csv)
-
-    beatmaps_df["beatmap_id"] = beatmaps_df["id"].str.split("-").str[0]
-    hit_objects_df["beatmap_id"] = hit_objects_df["id"].str.split("-").str[0]
-    time_points_df["beatmap_id"] = time_points_df["id"].str.split("-").str[0]
-
-    beatmaps_df = beatmaps_df[~beatmaps_df["beatmap_id"].isin(ids_to_remove)]
-    hit_objects_df = hit_objects_df[~hit_objects_df["beatmap_id"].isin(ids_to_remove)]
-    time_points_df = time_points_df[~time_points_df["beatmap_id"].isin(ids_to_remove)]
-
-    beatmaps_df.to_csv(beatmaps_csv, index=False)
-    hit_objects_df.to_csv(hit_objects_csv, index=False)
-    time_points_df.to_csv(time_points_csv, index=False)
-
-    print(f"Removed rows with IDs {ids_to_remove} from the CSV files.")
-
-
-def fix_bom_issue(folder_path):
-    file_path = os.path.join(folder_path, os.listdir(folder_path)[0])
-    new_file_path = os.path.join(folder_path, "fixed.mp3")
-    subprocess.run(
-        [
-            "ffmpeg",
-            "-y",
-            "-i",
-            file_path,
-            "-c",
-            "copy",
-            new_file_path,
-        ],
-        check=True,
-    )
-    os.remove(file_path)
 
+def remove_rows_by_ids(dataset_folder, ids_to_remove, storage="csv"):
+    storage = get_storage(storage, dataset_folder)
 
-def fix_header_issue(folder_path):
-    file_path = os.path.join(folder_path, os.listdir(folder_path)[0])
-    new_file_path = os.path.join(folder_path, "fixed.mp3")
-    subprocess.run(
-        [
-            "ffmpeg",
-            "-y",
-            "-i",
-            file_path,
-            "-acodec",
-            "libmp3lame",
-            "-b:a",
-            "192k",
-            new_file_path,
-        ],
-        check=True,
-    )
-    os.remove(file_path)
+    for table in ["beatmaps", "hit_objects", "timing_points"]:
+        storage.remove(table, ids_to_remove)
+    prune_audio(dataset_folder, remove_ids=ids_to_remove)
+
+    print(f"Removed rows with IDs {ids_to_remove} from the dataset tables.")
+
+
+def audio_file(folder_path):
+    return os.path.join(folder_path, os.listdir(folder_path)[0])
 
 
-def is_audio_corrupted(folder_path):
+def run_ffmpeg(args, timeout):
     try:
-        filename = os.listdir(folder_path)[0]
-        file_path = os.path.join(folder_path, filename)
-        result = subprocess.run(
-            [
-                "ffmpeg",
-                "-v",
-                "error",
-                "-i",
-                os.path.join(folder_path, file_path),
-                "-f",
-                "null",
-                "-",
-            ],
+        return subprocess.run(
+            ["ffmpeg", *args],
             stderr=subprocess.PIPE,
             stdout=subprocess.DEVNULL,
+            timeout=timeout,
         )
-        if result.stderr:
-            print(f"Corruption detected in {file_path}:\n{result.stderr.decode()}")
-            return True
-        return False
-    except FileNotFoundError:
-        return True
+    except subprocess.TimeoutExpired:
+        return subprocess.CompletedProcess(
+            args, -1, stderr=f"Timed out after {timeout}s".encode()
+        )
+
+
+# Re-encodes into fixed.mp3 through a temporary file, so a failed or timed out
+# fix never leaves a second file in the folder. Returns the error, if any.
+def repair_audio(file_path, codec_args, timeout=None):
+    folder_path = os.path.dirname(file_path)
+    tmp_file_path = os.path.join(folder_path, "fixed.tmp.mp3")
+    result = run_ffmpeg(["-y", "-i", file_path, *codec_args, tmp_file_path], timeout)
+    if result.returncode != 0:
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
+        return result.stderr.decode(errors="replace") or "ffmpeg failed"
+
+    os.remove(file_path)
+    os.replace(tmp_file_path, os.path.join(folder_path, "fixed.mp3"))
+    return ""
+
+
+def fix_bom_issue(file_path, timeout=None):
+    return repair_audio(file_path, ["-c", "copy"], timeout)
 
 
-def fix_corrupted_audios(dataset_folder):
+def fix_header_issue(file_path, timeout=None):
+    return repair_audio(file_path, ["-acodec", "libmp3lame", "-b:a", "192k"], timeout)
+
+
+# Decodes the whole file, any error output means it's corrupted.
+def check_audio(file_path, timeout=None):
+    result = run_ffmpeg(["-v", "error", "-i", file_path, "-f", "null", "-"], timeout)
+    return result.stderr.decode(errors="replace")
+
+
+FIXES = [("fix_header", fix_header_issue), ("fix_bom", fix_bom_issue)]
+
+
+# Check, then try each fix in turn until the file decodes cleanly. Runs in a
+# worker thread, the decoding itself happens in the ffmpeg subprocesses.
+def check_and_fix(folder_path, timeout=None):
+    result = {"id": os.path.basename(folder_path), "file": None, "steps": []}
+    try:
+        file_path = audio_file(folder_path)
+    except (FileNotFoundError, IndexError):
+        result["status"] = "missing"
+        return result
+
+    error = check_audio(file_path, timeout)
+    result["steps"].append({"step": "check", "error": error})
+    if error:
+        # The fixes replace the file, keep what the original looked like.
+        result["original"] = file_fingerprint(file_path)
+    for step, fix in FIXES:
+        if not error:
+            break
+        fix_error = fix(file_path, timeout)
+        result["steps"].append({"step": step, "error": fix_error})
+        file_path = audio_file(folder_path)
+        error = check_audio(file_path, timeout)
+        result["steps"].append({"step": "recheck", "error": error})
+
+    result["file"] = os.path.basename(file_path)
+    if error:
+        result["status"] = "corrupted"
+    else:
+        result["status"] = "fixed" if len(result["steps"]) > 1 else "ok"
+    return result
+
+
+def fix_corrupted_audios(dataset_folder, storage="csv", workers=None, timeout=600):
     audio_path = os.path.join(dataset_folder, "audio")
-    corrupted = []
-
-    for folder in tqdm(os.listdir(audio_path), desc="Checking audio files"):
-        folder_path = os.path.join(audio_path, folder)
-        if is_audio_corrupted(folder_path):
-            corrupted.append(folder_path)
-
-    for beatmap_path in tqdm(corrupted, desc="Fixing Header issue"):
-        try:
-            fix_header_issue(beatmap_path)
-        except:
-            continue
-
-    remaining = []
-    for beatmap_path in tqdm(corrupted, desc="Checking remaining files."):
-        if is_audio_corrupted(beatmap_path):
-            remaining.append(beatmap_path)
-
-    for beatmap_path in tqdm(remaining, desc="Fixing BOM issue"):
-        try:
-            fix_bom_issue(beatmap_path)
-        except:
-            continue
-
-    cant_fix = []
-    for beatmap_path in tqdm(remaining, desc="Checking remaining files."):
-        if is_audio_corrupted(beatmap_path):
-            cant_fix.append(beatmap_path)
-    cant_fix_ids = [path.split("/")[-1] for path in cant_fix]
-
-    for beatmap_id in cant_fix_ids:
-        shutil.rmtree(os.path.join(audio_path, beatmap_id))
+    log_file = os.path.join(dataset_folder, "audio_check_log.jsonl")
+
+    # Files unchanged since their last check keep its result, known bad ones
+    # are removed again without decoding them. The log keeps the results of
+    # earlier runs, new checks are appended to it.
+    manifest = AudioManifest(dataset_folder)
+    folder_paths = []
+    counts = Counter()
+    cant_fix_ids = []
+    for folder in os.listdir(audio_path):
+        status = manifest.status(folder)
+        if status is None:
+            folder_paths.append(os.path.join(audio_path, folder))
+        else:
+            counts[f"unchanged {status}"] += 1
+            if status in BAD_STATUSES:
+                cant_fix_ids.append(folder)
+
+    try:
+        with (
+            ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor,
+            open(log_file, "a") as log,
+        ):
+            results = executor.map(
+                partial(check_and_fix, timeout=timeout), folder_paths
+            )
+            for result in tqdm(
+                results, total=len(folder_paths), desc="Checking audio files"
+            ):
+                log.write(json.dumps(result) + "\n")
+                manifest.record(
+                    result["id"],
+                    result["status"],
+                    result.get("original") if result["status"] == "corrupted" else None,
+                )
+                counts[result["status"]] += 1
+                if result["status"] in BAD_STATUSES:
+                    cant_fix_ids.append(result["id"])
+    finally:
+        manifest.save()
+
+    print(", ".join(f"{count} {status}" for status, count in counts.items()))
 
     print(f"{len(cant_fix_ids)} beatmaps couldn't fix. Removing...")
-    remove_rows_by_ids(dataset_folder, cant_fix_ids)
+    remove_rows_by_ids(dataset_folder, cant_fix_ids, storage)
 
 
 def main():
@@ -141,10 +161,28 @@ def main():
         required=True,
         help="Path to the folder containing dataset folders.",
     )
+    parser.add_argument(
+        "--storage",
+        choices=STORAGES,
+        default="csv",
+        help="Storage format of the dataset tables.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of ffmpeg processes to run at once, defaults to the CPU count.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=600,
+        help="Seconds before a single ffmpeg call is killed.",
+    )
 
     args = parser.parse_args()
 
-    fix_corrupted_audios(args.dataset_folder)
+    fix_corrupted_audios(args.dataset_folder, args.storage, args.workers, args.timeout)
 
 
 if __name__ == "__main__":
@@ -1,98 +1,312 @@
+import csv
+import io
 import os
+import sys
+import zipfile
+import zlib
+import signal
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
-from beatmap_processor import BeatmapProcessor
+from beatmap_processor import BeatmapProcessor, read_audio_filename
 from data_exporter import DataExporter
-import pandas as pd
+from ledger import beatmapset_hash, ingestion_ledger
+from schema import get_beatmapset_ids
+from storage import STORAGES
 import shutil
 
+# A damaged archive member or a .osu that isn't UTF-8 only skips its beatmapset.
+CORRUPTED_ERRORS = (zipfile.BadZipFile, zlib.error, UnicodeDecodeError)
 
-def processed_beatmaps(dataset_path):
-    beatmaps_path = os.path.join(dataset_path, "beatmaps.csv")
-    df = pd.read_csv(beatmaps_path)
-    return set(df["id"].astype(str).str.split("-").str[0])
 
+# Row counts per beatmapset of a dataset generated before the ingestion ledger.
+def existing_row_counts(storage, tables):
+    counts = {}
+    for table in tables:
+        for chunk in storage.iter_chunks(table, columns=["id"]):
+            for beatmapset_id, count in (
+                get_beatmapset_ids(chunk, table).value_counts().items()
+            ):
+                counts.setdefault(beatmapset_id, dict.fromkeys(tables, 0))
+                counts[beatmapset_id][table] += count
+    return counts
 
-def process_folder(input_folder, dataset_path):
-    data_exporter = DataExporter(dataset_path)
 
-    processed = processed_beatmaps(dataset_path)
+# Sets with a beatmaps row were fully written by the old code (it came last),
+# they are taken over as they are. The others were interrupted and get
+# ingested again.
+def adopt_existing_rows(ledger, storage, tables, hashes):
+    ledger.update(
+        [
+            {
+                "beatmapset_id": beatmapset_id,
+                "sha256": hashes.get(beatmapset_id, ""),
+                "status": "done" if counts["beatmaps"] else "pending",
+                **counts,
+            }
+            for beatmapset_id, counts in existing_row_counts(storage, tables).items()
+        ]
+    )
+
+
+def entry_hash(entry_path):
+    try:
+        return beatmapset_hash(entry_path)
+    except zipfile.BadZipFile:
+        return None
+
+
+def is_osz(entry):
+    return entry.lower().endswith(".osz")
+
+
+# Beatmapset folders and .osz archives are both named "<name>-<beatmapset_id>".
+def entry_name(entry):
+    return os.path.splitext(entry)[0] if is_osz(entry) else entry
+
+
+def parse_beatmapset(entry_path):
+    # Returns the rows, the skipped .osu files and the error that made the
+    # whole beatmapset unreadable, if any.
+    try:
+        rows, skipped_files = read_beatmapset(entry_path)
+    except CORRUPTED_ERRORS as e:
+        return None, [], str(e) or type(e).__name__
+    return rows, skipped_files, None
+
+
+def read_beatmapset(entry_path):
+    beatmapsetId = entry_name(entry_path).split("-")[-1]
+
+    # .osu members are parsed straight from the archive, nothing is extracted.
+    if is_osz(entry_path):
+        with zipfile.ZipFile(entry_path) as archive:
+            osu_files = [name for name in archive.namelist() if name.endswith(".osu")]
+            return parse_osu_files(archive, osu_files, beatmapsetId)
+
+    osu_files = [file for file in os.listdir(entry_path) if file.endswith(".osu")]
+    return parse_osu_files(entry_path, osu_files, beatmapsetId)
+
+
+def parse_osu_files(beatmapset_folder, osu_files, beatmapsetId):
+    rows = {"beatmaps": [], "hit_objects": [], "timing_points": []}
+    skipped_files = []
+
+    for index, osu_file in enumerate(osu_files):
+        id = beatmapsetId + "-" + str(index)
+        processor = BeatmapProcessor(beatmapset_folder, osu_file)
+        if not processor.is_mode_osu:
+            skipped_files.append(osu_file)
+            continue
+        data = processor.get_data(columnar=True)
+        for table, table_rows in DataExporter.get_rows(data, id).items():
+            rows[table] += table_rows
+
+    return rows, skipped_files
+
+
+# Copies the audio file named by the first .osu, for an archive only that
+# member is decompressed. Raises IndexError if there is no .osu file.
+def copy_audio(entry_path, audio_folder):
+    if is_osz(entry_path):
+        with zipfile.ZipFile(entry_path) as archive:
+            names = archive.namelist()
+            osu_file = [name for name in names if name.lower().endswith((".osu"))][0]
+
+            with archive.open(osu_file) as f:
+                lines = io.TextIOWrapper(f, encoding="utf-8").readlines()
+
+            audio_files = {name.lower(): name for name in names}
+            audio_file = audio_files[read_audio_filename(lines)]
+
+            with (
+                archive.open(audio_file) as src,
+                open(
+                    os.path.join(audio_folder, os.path.basename(audio_file)), "wb"
+                ) as dst,
+            ):
+                shutil.copyfileobj(src, dst)
+        return
+
+    osu_file = [f for f in os.listdir(entry_path) if f.lower().endswith((".osu"))][0]
+
+    audio_files = {f.lower(): f for f in os.listdir(entry_path)}
+
+    with open(os.path.join(entry_path, osu_file), "r", encoding="utf-8") as f:
+        lines = f.readlines()
+
+    audio_file = audio_files[read_audio_filename(lines)]
+
+    shutil.copy2(
+        os.path.join(entry_path, audio_file),
+        os.path.join(audio_folder, audio_file),
+    )
+
+
+def map_beatmapsets(function, entry_paths, workers):
+    # Results are yielded in input order so ids and csv rows stay deterministic.
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(function, entry_paths, chunksize=8)
+    else:
+        yield from map(function, entry_paths)
+
 
-    beatmap_folders = [
+def process_folder(
+    input_folder, dataset_path, workers=1, flush_threshold=100_000, storage="csv"
+):
+    # Beatmapsets are committed to the ledger once their rows are flushed.
+    ledger = ingestion_ledger(dataset_path)
+    written = []
+
+    def commit_written():
+        ledger.update(
+            [
+                {"beatmapset_id": beatmapset_id, "sha256": sha256, "status": "done"}
+                | counts
+                for beatmapset_id, sha256, counts in written
+            ]
+        )
+        written.clear()
+
+    data_exporter = DataExporter(
+        dataset_path, flush_threshold, storage, on_flush=commit_written
+    )
+    storage = data_exporter.storage
+
+    entries = [
         entry
         for entry in os.listdir(input_folder)
-        if os.path.isdir(os.path.join(input_folder, entry))
-        and not entry.split("-")[1] in processed
+        if os.path.isdir(os.path.join(input_folder, entry)) or is_osz(entry)
     ]
+    beatmapset_ids = {entry: entry_name(entry).split("-")[1] for entry in entries}
+    hashes = dict(
+        zip(
+            entries,
+            tqdm(
+                map_beatmapsets(
+                    entry_hash,
+                    [os.path.join(input_folder, entry) for entry in entries],
+                    workers,
+                ),
+                total=len(entries),
+                desc="Hashing beatmapsets",
+            ),
+        )
+    )
 
-    skipped_files = []
+    if not ledger.exists():
+        adopt_existing_rows(
+            ledger,
+            storage,
+            data_exporter.tables,
+            {beatmapset_ids[entry]: sha256 for entry, sha256 in hashes.items()},
+        )
+    ledger.compact()
 
-    with tqdm(total=len(beatmap_folders), desc="Processing beatmapset folders") as pbar:
-        for entry in beatmap_folders:
-            entry_path = os.path.join(input_folder, entry)
+    # New, changed and previously interrupted beatmapsets. Rows they already
+    # have are removed before any new row is written.
+    beatmap_entries = []
+    for entry in entries:
+        ledger_entry = ledger.get(beatmapset_ids[entry])
+        if (
+            ledger_entry is None
+            or ledger_entry["status"] != "done"
+            or ledger_entry["sha256"] != hashes[entry]
+        ):
+            beatmap_entries.append(entry)
+    stale_ids = [
+        beatmapset_ids[entry]
+        for entry in beatmap_entries
+        if beatmapset_ids[entry] in ledger
+    ]
+    ledger.update(
+        [
+            {
+                "beatmapset_id": beatmapset_ids[entry],
+                "sha256": hashes[entry],
+                "status": "pending",
+            }
+            for entry in beatmap_entries
+        ]
+    )
+    for table in data_exporter.tables:
+        storage.remove(table, stale_ids)
+    print(
+        f"Ingesting {len(beatmap_entries)} of {len(entries)} beatmapsets, "
+        f"{len(stale_ids)} of them changed."
+    )
 
-            osu_files = [
-                file for file in os.listdir(entry_path) if file.endswith(".osu")
-            ]
-            beatmapsetId = entry_path.split("-")[-1]
+    entry_paths = [os.path.join(input_folder, entry) for entry in beatmap_entries]
 
-            for index, osu_file in enumerate(osu_files):
-                id = beatmapsetId + "-" + str(index)
-                processor = BeatmapProcessor(entry_path, osu_file)
-                if not processor.is_mode_osu:
-                    skipped_files.append(osu_file)
-                    continue
-                data = processor.get_data()
-                data_exporter.write_data(data, id)
+    skipped_files = []
+    corrupted = []
 
+    with (
+        data_exporter,
+        tqdm(total=len(beatmap_entries), desc="Processing beatmapsets") as pbar,
+    ):
+        for entry, (rows, skipped, error) in zip(
+            beatmap_entries, map_beatmapsets(parse_beatmapset, entry_paths, workers)
+        ):
+            if error is not None:
+                corrupted.append((entry, error))
+            else:
+                counts = {table: len(table_rows) for table, table_rows in rows.items()}
+                written.append((beatmapset_ids[entry], hashes[entry], counts))
+                data_exporter.write_rows(rows)
+            skipped_files += skipped
             pbar.update(1)
     print(skipped_files)
     print(f"Skipped {len(skipped_files)} beatmaps that modes are not osu.")
 
-    with tqdm(total=len(beatmap_folders), desc="Copying audio files") as pbar:
+    corrupted_entries = {entry for entry, _ in corrupted}
+    beatmap_entries = [
+        entry for entry in beatmap_entries if entry not in corrupted_entries
+    ]
+    with tqdm(total=len(beatmap_entries), desc="Copying audio files") as pbar:
 
-        for entry in beatmap_folders:
+        for entry in beatmap_entries:
             entry_path = os.path.join(input_folder, entry)
-            audio_files = [
-                f
-                for f in os.listdir(entry_path)
-                if f.lower().endswith((".mp3", ".ogg"))
-            ]
-            audio_folder = os.path.join(dataset_path, "audio", entry.split("-")[1])
+            audio_folder = os.path.join(dataset_path, "audio", beatmapset_ids[entry])
+            # A changed beatmapset may point to another audio file.
+            shutil.rmtree(audio_folder, ignore_errors=True)
             os.makedirs(audio_folder, exist_ok=True)
 
             try:
-                osu_file = [
-                    f for f in os.listdir(entry_path) if f.lower().endswith((".osu"))
-                ][0]
-            except:
+                copy_audio(entry_path, audio_folder)
+            except IndexError:
                 print(
                     "Couldn't find .osu file in",
                     entry_path,
                     "You may need to add manually.",
                 )
                 continue
-
-            audio_files = {f.lower(): f for f in os.listdir(entry_path)}
-
-            audio_filename = ""
-
-            with open(os.path.join(entry_path, osu_file), "r", encoding="utf-8") as f:
-                lines = f.readlines()
-            for line in lines:
-                if line.startswith("AudioFilename"):
-                    audio_filename = line.split(":")[1].strip().lower()
-                    continue
-
-            audio_file = audio_files[audio_filename.lower()]
-
-            shutil.copy2(
-                os.path.join(entry_path, audio_file),
-                os.path.join(audio_folder, audio_file),
-            )
+            except CORRUPTED_ERRORS as e:
+                # Its rows are written already, pending gets it ingested again.
+                corrupted.append((entry, str(e) or type(e).__name__))
+                ledger.update(
+                    [
+                        {
+                            "beatmapset_id": beatmapset_ids[entry],
+                            "sha256": hashes[entry],
+                            "status": "pending",
+                        }
+                    ]
+                )
+                continue
 
             pbar.update(1)
 
+    # Rewritten every run, corrupted beatmapsets are retried next time.
+    summary_file = os.path.join(dataset_path, "corrupted_beatmapsets.csv")
+    with open(summary_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["entry", "error"])
+        writer.writerows(corrupted)
+    if corrupted:
+        print(f"Skipped {len(corrupted)} corrupted beatmapsets, see {summary_file}")
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -101,17 +315,44 @@ def main():
     parser.add_argument(
         "--input_folder",
         required=True,
-        help="Path to the folder containing songs folders.",
+        help="Path to the folder containing .osz files or extracted songs folders.",
     )
     parser.add_argument(
         "--dataset_path",
         required=True,
         help="Dataset path that will create csv files.",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes parsing beatmapsets in parallel.",
+    )
+    parser.add_argument(
+        "--flush_threshold",
+        type=int,
+        default=100_000,
+        help="Number of buffered csv rows that triggers a write to disk.",
+    )
+    parser.add_argument(
+        "--storage",
+        choices=STORAGES,
+        default="csv",
+        help="Storage format of the dataset tables.",
+    )
 
     args = parser.parse_args()
 
-    process_folder(args.input_folder, args.dataset_path)
+    # Turn SIGTERM into an exception so buffered rows still get flushed.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+    process_folder(
+        args.input_folder,
+        args.dataset_path,
+        args.workers,
+        args.flush_threshold,
+        args.storage,
+    )
 
 
 if __name__ == "__main__":
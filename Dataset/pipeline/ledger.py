@@ -0,0 +1,115 @@
+import csv
+import hashlib
+import os
+import zipfile
+
+INGESTION_COLUMNS = [
+    "beatmapset_id",
+    "sha256",
+    "status",
+    "beatmaps",
+    "hit_objects",
+    "timing_points",
+]
+STAGE_COLUMNS = ["beatmapset_id", "sha256"]
+
+
+# Per beatmapset csv ledger. Entries are appended as they change and the latest
+# line of a beatmapset wins, like mels_index.csv, so an interrupted run keeps
+# everything recorded so far. compact() rewrites it with one line per set.
+class Ledger:
+    def __init__(self, file, columns):
+        self.file = file
+        self.columns = columns
+        self.entries = {}
+        self.load()
+
+    def exists(self):
+        return os.path.exists(self.file)
+
+    def load(self):
+        if not self.exists():
+            return
+        with open(self.file, "r", newline="") as f:
+            for entry in csv.DictReader(f):
+                self.entries[entry["beatmapset_id"]] = entry
+
+    def __contains__(self, beatmapset_id):
+        return beatmapset_id in self.entries
+
+    def get(self, beatmapset_id):
+        return self.entries.get(beatmapset_id)
+
+    def hashes(self, status=None):
+        return {
+            beatmapset_id: entry["sha256"]
+            for beatmapset_id, entry in self.entries.items()
+            if status is None or entry.get("status") == status
+        }
+
+    def update(self, entries):
+        entries = [{**dict.fromkeys(self.columns, ""), **entry} for entry in entries]
+        if not entries:
+            return
+
+        new_file = not self.exists()
+        with open(self.file, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=self.columns)
+            if new_file:
+                writer.writeheader()
+            writer.writerows(entries)
+
+        for entry in entries:
+            self.entries[entry["beatmapset_id"]] = entry
+
+    def compact(self):
+        os.makedirs(os.path.dirname(self.file) or ".", exist_ok=True)
+        tmp_file = f"{self.file}.tmp"
+        with open(tmp_file, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=self.columns)
+            writer.writeheader()
+            writer.writerows(self.entries.values())
+        os.replace(tmp_file, self.file)
+
+
+def ingestion_ledger(dataset_folder):
+    return Ledger(
+        os.path.join(dataset_folder, "ingestion_ledger.csv"), INGESTION_COLUMNS
+    )
+
+
+# Ledger of a derived table (formatted, encoded), with the source hash of every
+# beatmapset the table holds rows for.
+def table_ledger(storage, table):
+    return Ledger(os.path.join(storage.folder, f"{table}_ledger.csv"), STAGE_COLUMNS)
+
+
+# Beatmapsets whose hash in source differs from the one in target.
+def changed_ids(source_hashes, target_hashes):
+    return {
+        beatmapset_id
+        for beatmapset_id, sha256 in source_hashes.items()
+        if target_hashes.get(beatmapset_id) != sha256
+    }
+
+
+# Content hash of an extracted beatmapset folder or .osz archive. The .osu
+# files are hashed in full, other files only by name and size. For archives
+# the CRCs from the zip directory are used, nothing is decompressed.
+def beatmapset_hash(entry_path):
+    digest = hashlib.sha256()
+    if entry_path.lower().endswith(".osz"):
+        with zipfile.ZipFile(entry_path) as archive:
+            for info in sorted(archive.infolist(), key=lambda info: info.filename):
+                digest.update(
+                    f"{info.filename}\0{info.CRC}\0{info.file_size}\n".encode()
+                )
+        return digest.hexdigest()
+
+    for file in sorted(os.listdir(entry_path)):
+        path = os.path.join(entry_path, file)
+        digest.update(f"{file}\0{os.path.getsize(path)}\n".encode())
+        if file.endswith(".osu"):
+            with open(path, "rb") as f:
+                digest.update(hashlib.file_digest(f, "sha256").digest())
+    return digest.hexdigest()
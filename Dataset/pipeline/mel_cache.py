@@ -0,0 +1,73 @@
+import hashlib
+import os
+
+import numpy as np
+
+EVICT_TO = 0.9
+
+
+# Log mel spectrograms keyed by the sha256 of the audio file and the mel
+# parameters, so the same song under several beatmapsets or datasets is only
+# decoded once. Least recently used entries (by mtime) are evicted once the
+# folder grows past max_bytes, down to EVICT_TO of it so the next scan is a
+# while away. Entries are written atomically, several processes can share one
+# cache folder.
+class MelCache:
+    def __init__(self, folder, max_bytes):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.max_bytes = max_bytes
+        # Size of the folder as far as this process knows, the folder is only
+        # scanned again once that passes max_bytes.
+        self.total = sum(size for _, size, _ in self.entries())
+
+    def key(self, audio_path, params):
+        with open(audio_path, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+        return "-".join([digest, *(f"{k}{v}" for k, v in sorted(params.items()))])
+
+    def path(self, key):
+        return os.path.join(self.folder, f"{key}.npy")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            value = np.load(path)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return value
+
+    def put(self, key, value):
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, value)
+            size = f.tell()
+        os.replace(tmp_path, path)
+
+        self.total += size
+        if self.total > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(".npy"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        # Rescanned so entries put by other processes are counted as well.
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes * EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.total = total
@@ -0,0 +1,118 @@
+import csv
+import os
+import re
+
+import numpy as np
+
+# Datasets formatted before the store saved every chunk as {song_id}_{idx}.npy.
+LEGACY_CHUNK_PATTERN = re.compile(r"(.+)_(\d+)\.npy")
+
+
+# All mel spectrogram chunks of a dataset in one float32 file, readable as a
+# (chunks, chunk_size, n_mels) memmap. mels_index.csv maps every song id to its
+# first chunk and chunk count. Data is written before the index line, so a
+# crash can only leave unindexed chunks that the next append overwrites.
+class MelStore:
+    def __init__(self, folder, chunk_size=512, n_mels=128):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.data_file = os.path.join(folder, "mels.bin")
+        self.index_file = os.path.join(folder, "mels_index.csv")
+        self.chunk_size = chunk_size
+        self.n_mels = n_mels
+        self.chunk_bytes = chunk_size * n_mels * np.dtype(np.float32).itemsize
+
+        self.index = {}
+        self.num_chunks = 0
+        self.memmap = None
+        self.load_index()
+        self.import_legacy_chunks()
+
+    def load_index(self):
+        if not os.path.exists(self.index_file):
+            with open(self.index_file, "w", newline="") as f:
+                csv.writer(f).writerow(["song_id", "start", "count"])
+            return
+
+        with open(self.index_file, "r", newline="") as f:
+            for song_id, start, count in csv.reader(f):
+                if song_id == "song_id":
+                    continue
+                start, count = int(start), int(count)
+                # A song written twice keeps its latest chunks.
+                self.index[song_id] = (start, count)
+                self.num_chunks = max(self.num_chunks, start + count)
+
+    def import_legacy_chunks(self):
+        # Songs that only have .npy chunks are appended in chunk order, so older
+        # datasets don't have to be formatted again. The .npy files are kept.
+        legacy = {}
+        for name in os.listdir(self.folder):
+            match = LEGACY_CHUNK_PATTERN.fullmatch(name)
+            if match and match[1] not in self.index:
+                legacy.setdefault(match[1], []).append((int(match[2]), name))
+
+        for song_id, files in sorted(legacy.items()):
+            files.sort()
+            if [idx for idx, _ in files] != list(range(len(files))):
+                raise ValueError(
+                    f"Mel chunks of song {song_id} in {self.folder} are incomplete, "
+                    "remove its .npy files and format the song again."
+                )
+            chunks = [np.load(os.path.join(self.folder, name)) for _, name in files]
+            self.append(song_id, np.stack(chunks))
+
+        if legacy:
+            print(
+                f"Imported .npy mel chunks of {len(legacy)} songs into {self.data_file}."
+            )
+
+    def append(self, song_id, chunks):
+        chunks = np.ascontiguousarray(chunks, dtype=np.float32)
+        start = self.num_chunks
+
+        mode = "r+b" if os.path.exists(self.data_file) else "wb"
+        with open(self.data_file, mode) as f:
+            f.seek(start * self.chunk_bytes)
+            f.write(chunks.tobytes())
+            f.truncate()
+
+        with open(self.index_file, "a", newline="") as f:
+            csv.writer(f).writerow([song_id, start, len(chunks)])
+
+        self.index[str(song_id)] = (start, len(chunks))
+        self.num_chunks = start + len(chunks)
+        self.memmap = None
+
+    def __contains__(self, song_id):
+        return str(song_id) in self.index
+
+    def entry(self, song_id):
+        if str(song_id) not in self.index:
+            raise KeyError(
+                f"Song {song_id} has no mel spectrogram in {self.index_file}. "
+                "Remove its beatmapset from the formatted table and run "
+                "format_dataset.py again."
+            )
+        return self.index[str(song_id)]
+
+    def chunk_count(self, song_id):
+        return self.entry(song_id)[1]
+
+    def array(self):
+        if self.num_chunks == 0:
+            return np.empty((0, self.chunk_size, self.n_mels), dtype=np.float32)
+        if self.memmap is None:
+            self.memmap = np.memmap(
+                self.data_file,
+                dtype=np.float32,
+                mode="r",
+                shape=(self.num_chunks, self.chunk_size, self.n_mels),
+            )
+        return self.memmap
+
+    def get(self, song_id, chunk=None):
+        # Views into the memmap, nothing is copied until the data is used.
+        start, count = self.entry(song_id)
+        chunks = self.array()[start : start + count]
+        return chunks if chunk is None else chunks[chunk]
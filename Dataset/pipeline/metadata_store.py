@@ -0,0 +1,113 @@
+import sqlite3
+import time
+
+import pandas as pd
+
+DAY = 24 * 60 * 60
+
+# How long a fetched beatmapset stays fresh, by status. Ranked and approved
+# sets can't change anymore, None means they are never fetched again.
+STATUS_TTL = {
+    "ranked": None,
+    "approved": None,
+    "loved": 7 * DAY,
+    "graveyard": 7 * DAY,
+    "qualified": DAY,
+    "pending": DAY,
+    "wip": DAY,
+}
+DEFAULT_TTL = DAY
+
+
+class MetadataStore:
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS beatmapsets (
+                beatmapset_id TEXT PRIMARY KEY,
+                status TEXT,
+                ranked_date TEXT,
+                mapper_id INTEGER,
+                fetched_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS beatmaps (
+                beatmapset_id TEXT NOT NULL,
+                version TEXT NOT NULL,
+                difficulty_rating REAL,
+                PRIMARY KEY (beatmapset_id, version)
+            );
+            """
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def is_fresh(self, status, fetched_at, now):
+        ttl = STATUS_TTL.get(status, DEFAULT_TTL)
+        return ttl is None or now - fetched_at < ttl
+
+    def stale_ids(self, beatmapset_ids, now=None):
+        now = time.time() if now is None else now
+        fetched = {
+            beatmapset_id: (status, fetched_at)
+            for beatmapset_id, status, fetched_at in self.connection.execute(
+                "SELECT beatmapset_id, status, fetched_at FROM beatmapsets"
+            )
+        }
+        return [
+            beatmapset_id
+            for beatmapset_id in beatmapset_ids
+            if beatmapset_id not in fetched
+            or not self.is_fresh(*fetched[beatmapset_id], now)
+        ]
+
+    def save(self, beatmapset_id, metadata, fetched_at=None):
+        status, ranked_date, mapper_id, beatmaps = metadata
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO beatmapsets VALUES (?, ?, ?, ?, ?)",
+                (beatmapset_id, status, ranked_date, mapper_id, fetched_at),
+            )
+            self.connection.execute(
+                "DELETE FROM beatmaps WHERE beatmapset_id = ?", (beatmapset_id,)
+            )
+            self.connection.executemany(
+                "INSERT INTO beatmaps VALUES (?, ?, ?)",
+                [
+                    (beatmapset_id, version, difficulty_rating)
+                    for version, difficulty_rating in beatmaps.items()
+                ],
+            )
+
+    def get(self, beatmapset_id, version):
+        return self.connection.execute(
+            """
+            SELECT s.status, s.ranked_date, s.mapper_id, b.difficulty_rating
+            FROM beatmapsets s
+            JOIN beatmaps b ON b.beatmapset_id = s.beatmapset_id
+            WHERE s.beatmapset_id = ? AND b.version = ?
+            """,
+            (beatmapset_id, version),
+        ).fetchone()
+
+    def frame(self, beatmapset_ids):
+        # One row per (beatmapset_id, version), ready to be merged into the
+        # beatmaps table.
+        df = pd.read_sql_query(
+            """
+            SELECT s.beatmapset_id, b.version, s.status, s.ranked_date,
+                s.mapper_id, b.difficulty_rating
+            FROM beatmapsets s
+            JOIN beatmaps b ON b.beatmapset_id = s.beatmapset_id
+            """,
+            self.connection,
+        )
+        return df[df["beatmapset_id"].isin(set(beatmapset_ids))]
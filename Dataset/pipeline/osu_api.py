@@ -0,0 +1,170 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+
+API_URL = "https://osu.ppy.sh"
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# Fetches beatmapsets concurrently over one pooled session. Requests share a
+# token bucket rate limit, 429 and 5xx responses are retried with exponential
+# backoff (or Retry-After), and an expired token is refreshed once by
+# whichever thread sees the 401 first.
+class OsuApiClient:
+    def __init__(
+        self,
+        client_id,
+        client_secret,
+        api_url=API_URL,
+        concurrency=8,
+        rate_limit=10,
+        max_retries=5,
+        backoff=1.0,
+        timeout=30,
+    ):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.api_url = api_url.rstrip("/")
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.bucket = TokenBucket(rate_limit)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.token_lock = threading.Lock()
+        self.access_token = None
+        self.token_error = None
+
+    def get_access_token(self):
+        url = f"{self.api_url}/oauth/token"
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        data = {
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            "grant_type": "client_credentials",
+            "scope": "public",
+        }
+
+        response = self.session.post(
+            url, headers=headers, data=data, timeout=self.timeout
+        )
+        try:
+            access_token = response.json().get("access_token")
+        except ValueError:
+            access_token = None
+        if not access_token:
+            raise ValueError(
+                f"Couldn't get an osu! API token: {response.status_code} - "
+                f"{response.text}. Check the client id and secret."
+            )
+        return access_token
+
+    def refresh_token(self, expired_token):
+        # A failed token request is raised again by every thread, it is only
+        # made once.
+        with self.token_lock:
+            if self.token_error is not None:
+                raise self.token_error
+            if self.access_token == expired_token:
+                try:
+                    self.access_token = self.get_access_token()
+                except ValueError as e:
+                    self.token_error = e
+                    raise
+
+    def get(self, path):
+        url = f"{self.api_url}{path}"
+        if self.access_token is None:
+            self.refresh_token(None)
+
+        response = None
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            access_token = self.access_token
+            headers = {
+                "Authorization": f"Bearer {access_token}",
+                "Accept": "application/json",
+            }
+
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except requests.RequestException:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self.backoff * 2**attempt)
+                continue
+
+            if response.status_code == 401 and attempt < self.max_retries:
+                self.refresh_token(access_token)
+                continue
+
+            if response.status_code == 429 or response.status_code >= 500:
+                if attempt == self.max_retries:
+                    break
+                retry_after = response.headers.get("Retry-After")
+                if retry_after and retry_after.isdigit():
+                    time.sleep(int(retry_after))
+                else:
+                    time.sleep(self.backoff * 2**attempt)
+                continue
+
+            break
+
+        return response
+
+    def get_beatmapset_metadata(self, beatmapset_id):
+        try:
+            response = self.get(f"/api/v2/beatmapsets/{beatmapset_id}")
+        except requests.RequestException as e:
+            return f"Error: {e}"
+
+        if response.status_code == 200:
+            beatmapset = response.json()
+            ranked_date = beatmapset.get("ranked_date")
+            status = beatmapset.get("status", "Unknown")
+            mapper_id = beatmapset.get("user_id")
+
+            beatmaps = {}
+            for beatmap in beatmapset.get("beatmaps"):
+                beatmaps[beatmap["version"]] = beatmap["difficulty_rating"]
+
+            return (status, ranked_date, mapper_id, beatmaps)
+        else:
+            return f"Error: {response.status_code} - {response.text}"
+
+    def iter_beatmapsets_metadata(self, beatmapset_ids):
+        beatmapset_ids = list(beatmapset_ids)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            metadatas = executor.map(self.get_beatmapset_metadata, beatmapset_ids)
+            yield from zip(beatmapset_ids, tqdm(metadatas, total=len(beatmapset_ids)))
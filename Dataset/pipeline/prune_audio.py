@@ -0,0 +1,91 @@
+import argparse
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from storage import STORAGES, get_storage
+
+
+def folder_size(folder_path):
+    size = 0
+    for root, _, files in os.walk(folder_path):
+        for file in files:
+            size += os.path.getsize(os.path.join(root, file))
+    return size
+
+
+def remove_folder(folder_path, dry_run=False):
+    size = folder_size(folder_path)
+    if not dry_run:
+        shutil.rmtree(folder_path, ignore_errors=True)
+    return size
+
+
+# Removes the audio folders of beatmapsets that are either not in keep_ids or
+# in remove_ids. Both are turned into sets once, deletions run on a thread pool.
+def prune_audio(
+    dataset_folder, keep_ids=None, remove_ids=None, workers=8, dry_run=False
+):
+    audio_path = os.path.join(dataset_folder, "audio")
+    if not os.path.isdir(audio_path):
+        return [], 0
+
+    keep_ids = None if keep_ids is None else set(map(str, keep_ids))
+    remove_ids = set() if remove_ids is None else set(map(str, remove_ids))
+    folders = [
+        folder
+        for folder in os.listdir(audio_path)
+        if folder in remove_ids or (keep_ids is not None and folder not in keep_ids)
+    ]
+
+    folder_paths = [os.path.join(audio_path, folder) for folder in folders]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        size = sum(executor.map(partial(remove_folder, dry_run=dry_run), folder_paths))
+
+    verb = "Would remove" if dry_run else "Removed"
+    print(f"{verb} {len(folders)} audio folders, {size / 2**20:.1f} MiB.")
+    return folders, size
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Remove audio folders of beatmapsets missing from the beatmaps table."
+    )
+    parser.add_argument(
+        "--dataset_folder",
+        required=True,
+        help="Path to the folder containing dataset folders.",
+    )
+    parser.add_argument(
+        "--storage",
+        choices=STORAGES,
+        default="csv",
+        help="Storage format of the dataset tables.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of folders deleted at once.",
+    )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="Only report what would be removed and the bytes reclaimed.",
+    )
+
+    args = parser.parse_args()
+
+    storage = get_storage(args.storage, args.dataset_folder)
+    beatmap_ids = storage.read("beatmaps", columns=["id"])["id"]
+    prune_audio(
+        args.dataset_folder,
+        keep_ids=beatmap_ids.str.split("-").str[0],
+        workers=args.workers,
+        dry_run=args.dry_run,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import os
+
+import pandas as pd
+
+TABLE_COLUMNS = {
+    "beatmaps": [
+        "id",
+        "title",
+        "artist",
+        "creator",
+        "version",
+        "hp_drain_rate",
+        "circle_size",
+        "overall_difficulty",
+        "approach_rate",
+        "slider_multiplier",
+        "slider_tick_rate",
+        "break_points",
+    ],
+    "hit_objects": [
+        "id",
+        "time",
+        "type",
+        "x",
+        "y",
+        "hit_sound",
+        "path",
+        "repeat",
+        "length",
+        "spinner_time",
+        "new_combo",
+    ],
+    "timing_points": [
+        "id",
+        "time",
+        "beat_length",
+        "meter",
+        "sample_set",
+        "volume",
+        "uninherited",
+        "effects",
+    ],
+}
+
+COL_TYPES = {
+    "id": "string",
+    "time": "float64",
+    "type": "string",
+    "x": "int16",
+    "y": "int16",
+    "hit_sound": "int8",
+    "path": "string",
+    "repeat": "int16",
+    "spinner_time": "int32",
+    "new_combo": "bool",
+    "slider_velocity": "float64",
+    "sample_set": "int8",
+    "volume": "int8",
+    "effects": "int8",
+    "difficulty_rating": "float16",
+    "meter": "int8",
+    "beat_length": "float64",
+    "mapper_id": "int64",
+    "beatmap_id": "int64",
+    "duration": "int64",
+    "delta_time": "int64",
+}
+
+TABLE_COLUMNS["formatted"] = list(COL_TYPES)
+TABLE_COLUMNS["encoded"] = ["beatmap_id", "chunk", "tokenized"]
+
+# Raw tables keep nullable types where the .osu file may leave a field empty.
+TABLE_TYPES = {
+    "beatmaps": {
+        "id": "string",
+        "title": "string",
+        "artist": "string",
+        "creator": "string",
+        "version": "string",
+        "hp_drain_rate": "float64",
+        "circle_size": "float64",
+        "overall_difficulty": "float64",
+        "approach_rate": "float64",
+        "slider_multiplier": "float64",
+        "slider_tick_rate": "float64",
+        "break_points": "string",
+        "status": "string",
+        "ranked_date": "string",
+        "mapper_id": "Int64",
+        "difficulty_rating": "float64",
+        "beatmap_id": "int64",
+    },
+    "hit_objects": {
+        "id": "string",
+        "time": "int64",
+        "type": "string",
+        "x": "int16",
+        "y": "int16",
+        "hit_sound": "int8",
+        "path": "string",
+        "repeat": "int16",
+        "length": "float64",
+        "spinner_time": "int32",
+        "new_combo": "bool",
+        "beatmap_id": "int64",
+    },
+    "timing_points": {
+        "id": "string",
+        "time": "float64",
+        "beat_length": "float64",
+        "meter": "Int16",
+        "sample_set": "Int8",
+        "volume": "Int16",
+        "uninherited": "Int8",
+        "effects": "Int32",
+        "beatmap_id": "int64",
+    },
+    "formatted": COL_TYPES,
+    "encoded": {
+        "beatmap_id": "string",
+        "chunk": "int32",
+        "tokenized": "string",
+    },
+}
+
+# Compact types for loading a table to work on it. Repeated strings become
+# categoricals and small numbers narrow ints, columns that go into arithmetic
+# keep their width so the outputs don't change.
+LOAD_TYPES = {
+    "beatmaps": TABLE_TYPES["beatmaps"],
+    "hit_objects": {
+        **TABLE_TYPES["hit_objects"],
+        "id": "category",
+        "time": "int32",
+        "type": "category",
+    },
+    "timing_points": {**TABLE_TYPES["timing_points"], "id": "category"},
+    "formatted": {
+        **COL_TYPES,
+        "id": "category",
+        "type": "category",
+        "difficulty_rating": "float32",
+        "duration": "int32",
+        "delta_time": "int32",
+    },
+    "encoded": TABLE_TYPES["encoded"],
+}
+
+# Column holding the "<beatmapset_id>-<index>" id of each table.
+ID_COLUMNS = {"encoded": "beatmap_id"}
+
+
+def table_name(table):
+    return os.path.basename(table)
+
+
+def id_column(table):
+    return ID_COLUMNS.get(table_name(table), "id")
+
+
+def load_types(table, columns):
+    types = LOAD_TYPES.get(table_name(table), {})
+    return {column: types[column] for column in columns if column in types}
+
+
+def get_beatmapset_ids(df, table):
+    return df[id_column(table)].astype(str).str.split("-").str[0]
+
+
+def apply_schema(df, table):
+    types = TABLE_TYPES.get(table_name(table), {})
+    df = df.copy()
+    for column, dtype in types.items():
+        if column not in df.columns:
+            continue
+        if dtype == "string":
+            df[column] = df[column].astype(dtype)
+        elif dtype == "bool":
+            df[column] = df[column].astype(str) == "True"
+        else:
+            df[column] = pd.to_numeric(df[column], errors="coerce").astype(dtype)
+    return df
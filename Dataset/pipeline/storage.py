@@ -0,0 +1,320 @@
+import csv
+import os
+import shutil
+import time
+
+import pandas as pd
+
+from schema import (
+    TABLE_COLUMNS,
+    apply_schema,
+    get_beatmapset_ids,
+    id_column,
+    load_types,
+    table_name,
+)
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    ds = None
+    pq = None
+
+PARTITION_COLUMN = "beatmapset_id"
+
+
+class CsvStorage:
+    name = "csv"
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.handles = {}
+
+    def path(self, table):
+        return os.path.join(self.folder, f"{table}.csv")
+
+    def exists(self, table):
+        return os.path.exists(self.path(table))
+
+    def init_table(self, table, columns):
+        if not self.exists(table):
+            os.makedirs(os.path.dirname(self.path(table)), exist_ok=True)
+            with open(self.path(table), "w", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                writer.writerow(columns)
+
+    def header(self, table):
+        return pd.read_csv(self.path(table), nrows=0).columns.tolist()
+
+    def read(
+        self, table, columns=None, beatmapset_ids=None, typed=False, **read_csv_kwargs
+    ):
+        # typed loads the columns with the compact LOAD_TYPES, parsed by
+        # pyarrow when it is installed unless another engine is passed.
+        usecols = columns
+        if beatmapset_ids is not None and columns is not None:
+            usecols = list(dict.fromkeys([*columns, id_column(table)]))
+        dtypes = load_types(table, usecols or self.header(table)) if typed else {}
+
+        if beatmapset_ids is None:
+            if typed and pa is not None:
+                read_csv_kwargs.setdefault("engine", "pyarrow")
+            return pd.read_csv(
+                self.path(table), usecols=usecols, dtype=dtypes, **read_csv_kwargs
+            )
+
+        # Filtered chunk by chunk, only the requested beatmapsets are held.
+        # Categoricals are set once the chunks are joined, each chunk would
+        # come with its own categories.
+        categories = {c: t for c, t in dtypes.items() if t == "category"}
+        keep = set(map(str, beatmapset_ids))
+        chunks = [
+            chunk[get_beatmapset_ids(chunk, table).isin(keep)]
+            for chunk in pd.read_csv(
+                self.path(table),
+                usecols=usecols,
+                dtype={c: t for c, t in dtypes.items() if c not in categories},
+                chunksize=500_000,
+                **read_csv_kwargs,
+            )
+        ]
+        df = pd.concat(chunks)
+        if columns is not None:
+            df = df[columns]
+        return df.astype({c: t for c, t in categories.items() if c in df.columns})
+
+    def iter_chunks(self, table, columns=None, chunksize=500_000, typed=False):
+        # Chunks would each get their own categories, typed leaves those out.
+        dtypes = load_types(table, columns or self.header(table)) if typed else {}
+        yield from pd.read_csv(
+            self.path(table),
+            usecols=columns,
+            dtype={c: t for c, t in dtypes.items() if t != "category"},
+            chunksize=chunksize,
+        )
+
+    def write(self, table, df):
+        df.to_csv(self.path(table), index=False)
+
+    def append(self, table, df):
+        df.to_csv(
+            self.path(table), mode="a", header=not self.exists(table), index=False
+        )
+
+    def filter_lines(self, table, keep):
+        # Streams the file into a copy with only the lines whose id passes keep
+        # and swaps it in, so memory doesn't grow with the table. Kept lines are
+        # copied as they are. The id column always comes first, so it can be
+        # split off without parsing the whole line.
+        if not self.exists(table):
+            return
+        if table in self.handles:
+            self.handles.pop(table).close()
+
+        path = self.path(table)
+        tmp_path = f"{path}.tmp"
+        with (
+            open(path, "r", newline="", encoding="utf-8") as src,
+            open(tmp_path, "w", newline="", encoding="utf-8") as dst,
+        ):
+            dst.write(next(src, ""))
+            dst.writelines(line for line in src if keep(line.split(",", 1)[0]))
+        os.replace(tmp_path, path)
+
+    def remove(self, table, beatmapset_ids):
+        remove_ids = set(map(str, beatmapset_ids))
+        if remove_ids:
+            self.filter_lines(table, lambda id: id.split("-")[0] not in remove_ids)
+
+    def keep_rows(self, table, ids):
+        ids = set(map(str, ids))
+        self.filter_lines(table, ids.__contains__)
+
+    def append_rows(self, table, rows):
+        if table not in self.handles:
+            self.handles[table] = open(
+                self.path(table), "a", newline="", encoding="utf-8", buffering=1 << 20
+            )
+        handle = self.handles[table]
+        csv.writer(handle).writerows(rows)
+        handle.flush()
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+        self.handles = {}
+
+
+# Every table is a hive partitioned parquet dataset, one partition per
+# beatmapset, typed with the schema from schema.TABLE_TYPES.
+class ParquetStorage:
+    name = "parquet"
+
+    def __init__(self, folder):
+        if ds is None:
+            raise ImportError("pyarrow is required for the parquet storage.")
+        self.folder = folder
+        self.partitioning = ds.partitioning(
+            pa.schema([(PARTITION_COLUMN, pa.string())]), flavor="hive"
+        )
+
+    def path(self, table):
+        return os.path.join(self.folder, f"{table}.parquet")
+
+    def exists(self, table):
+        return os.path.isdir(self.path(table))
+
+    def init_table(self, table, columns):
+        os.makedirs(os.path.dirname(self.path(table)), exist_ok=True)
+
+    def has_rows(self, table):
+        return self.exists(table) and bool(self.dataset(table).files)
+
+    def dataset(self, table):
+        return ds.dataset(
+            self.path(table), format="parquet", partitioning=self.partitioning
+        )
+
+    def empty(self, table, columns):
+        return pd.DataFrame(columns=columns or TABLE_COLUMNS.get(table_name(table)))
+
+    def read(
+        self, table, columns=None, beatmapset_ids=None, typed=False, **read_csv_kwargs
+    ):
+        # Parquet keeps its own types, keep_default_na=False is the only
+        # read_csv option that changes its result: missing strings read as "".
+        keep_default_na = read_csv_kwargs.pop("keep_default_na", True)
+        if read_csv_kwargs:
+            raise TypeError(
+                f"Parquet tables can't be read with {', '.join(read_csv_kwargs)}."
+            )
+
+        if not self.has_rows(table) or (
+            beatmapset_ids is not None and not len(beatmapset_ids)
+        ):
+            return self.empty(table, columns)
+
+        expression = None
+        if beatmapset_ids is not None:
+            expression = ds.field(PARTITION_COLUMN).isin(list(map(str, beatmapset_ids)))
+
+        arrow_table = self.dataset(table).to_table(columns=columns, filter=expression)
+        df = arrow_table.to_pandas().drop(columns=PARTITION_COLUMN, errors="ignore")
+        if not keep_default_na:
+            strings = df.select_dtypes(include=["object", "string"]).columns
+            df[strings] = df[strings].fillna("")
+        return df.astype(load_types(table, df.columns)) if typed else df
+
+    def iter_chunks(self, table, columns=None, chunksize=500_000, typed=False):
+        if not self.has_rows(table):
+            return
+        for batch in self.dataset(table).to_batches(
+            columns=columns, batch_size=chunksize
+        ):
+            df = batch.to_pandas().drop(columns=PARTITION_COLUMN, errors="ignore")
+            if typed:
+                types = load_types(table, df.columns)
+                df = df.astype({c: t for c, t in types.items() if t != "category"})
+            yield df
+
+    def write(self, table, df):
+        path = self.path(table)
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        self.write_partitions(tmp_path, table, df)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(tmp_path, exist_ok=True)
+        os.rename(tmp_path, path)
+
+    def append(self, table, df):
+        self.write_partitions(self.path(table), table, df)
+
+    def remove(self, table, beatmapset_ids):
+        # Every beatmapset is its own partition folder.
+        for beatmapset_id in set(map(str, beatmapset_ids)):
+            shutil.rmtree(
+                os.path.join(self.path(table), f"{PARTITION_COLUMN}={beatmapset_id}"),
+                ignore_errors=True,
+            )
+
+    def keep_rows(self, table, ids, chunksize=500_000):
+        # Scans the table batch by batch into a new dataset, keeping the rows
+        # whose id is in ids, and swaps it in.
+        if not self.has_rows(table):
+            return
+        path = self.path(table)
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        scanner = self.dataset(table).scanner(
+            filter=ds.field(id_column(table)).isin(list(map(str, ids))),
+            batch_size=chunksize,
+        )
+        self.write_dataset(scanner, tmp_path, len(self.dataset(table).files))
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(tmp_path, exist_ok=True)
+        os.rename(tmp_path, path)
+
+    def append_rows(self, table, rows):
+        self.append(table, pd.DataFrame(rows, columns=TABLE_COLUMNS[table_name(table)]))
+
+    def write_partitions(self, path, table, df):
+        if df.empty:
+            return
+        df = apply_schema(df, table)
+        df[PARTITION_COLUMN] = get_beatmapset_ids(df, table)
+        beatmapset_ids = df[PARTITION_COLUMN].unique()
+        self.write_dataset(
+            pa.Table.from_pandas(df, preserve_index=False), path, len(beatmapset_ids)
+        )
+        self.compact(path, beatmapset_ids)
+
+    def write_dataset(self, data, path, partitions):
+        # pyarrow refuses more than 1024 partitions per write by default. Files
+        # are named by write time, so a partition's files read in write order.
+        ds.write_dataset(
+            data,
+            path,
+            format="parquet",
+            partitioning=self.partitioning,
+            basename_template=f"part-{time.time_ns()}-{{i}}.parquet",
+            max_partitions=max(partitions, 1),
+            existing_data_behavior="overwrite_or_ignore",
+        )
+
+    def compact(self, path, beatmapset_ids):
+        # A beatmapset written by several appends has a file from each, they
+        # are merged so every partition stays a single file.
+        for beatmapset_id in beatmapset_ids:
+            folder = os.path.join(path, f"{PARTITION_COLUMN}={beatmapset_id}")
+            files = sorted(
+                os.path.join(folder, file)
+                for file in os.listdir(folder)
+                if file.endswith(".parquet")
+            )
+            if len(files) < 2:
+                continue
+            merged = pa.concat_tables([pq.read_table(file) for file in files])
+            tmp_file = os.path.join(folder, ".compact.tmp")
+            pq.write_table(merged, tmp_file)
+            os.replace(tmp_file, files[-1])
+            for file in files[:-1]:
+                os.remove(file)
+
+    def close(self):
+        pass
+
+
+STORAGES = {storage.name: storage for storage in [CsvStorage, ParquetStorage]}
+
+
+def get_storage(name, folder):
+    return STORAGES[name](folder)
+
+
+def get_file_storage(name, file):
+    # "dataset/formatted/formatted.csv" -> storage of "dataset/formatted", "formatted"
+    folder, table = os.path.split(os.path.splitext(file)[0])
+    return get_storage(name, folder), table
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# Folder of a dataset's binary encoding, next to its encoded table.
+TOKEN_STORE_FOLDER = "encoded_tokens"
+TOKEN_DTYPE = np.uint16
+INDEX_DTYPE = np.dtype(
+    [
+        ("beatmapset_id", np.int64),
+        ("difficulty", np.int32),
+        ("chunk", np.int32),
+        ("start", np.int64),
+        ("count", np.int64),
+    ]
+)
+
+
+def vocab_sha256(vocab_file):
+    with open(vocab_file, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def split_beatmap_id(beatmap_id):
+    beatmapset_id, difficulty = str(beatmap_id).split("-")
+    return int(beatmapset_id), int(difficulty)
+
+
+# Encoded beatmaps as token ids. tokens.npy is one flat uint16 array, index.npy
+# has a (beatmapset_id, difficulty, chunk, start, count) row for every chunk of
+# every beatmap, so a chunk's sequence is tokens[start : start + count]. Both
+# are plain .npy files that load as memmaps. vocab.json holds the hash of the
+# token2id.json the ids refer to, stores are only combined with the same one.
+class TokenStore:
+    def __init__(self, folder):
+        self.folder = folder
+        self.tokens_file = os.path.join(folder, "tokens.npy")
+        self.index_file = os.path.join(folder, "index.npy")
+        self.vocab_file = os.path.join(folder, "vocab.json")
+        self.ledger_file = os.path.join(folder, "ledger.csv")
+        self.lookup = None
+
+    def exists(self):
+        return os.path.exists(self.vocab_file)
+
+    def vocab(self):
+        with open(self.vocab_file, "r") as f:
+            return json.load(f)["sha256"]
+
+    def tokens(self):
+        return np.load(self.tokens_file, mmap_mode="r")
+
+    def index(self):
+        return np.load(self.index_file, mmap_mode="r")
+
+    def get(self, beatmap_id, chunk):
+        # A view into the tokens memmap, nothing is copied until it's used.
+        if self.lookup is None:
+            index = self.index()
+            self.lookup = {
+                (beatmapset_id, difficulty, chunk): (start, count)
+                for beatmapset_id, difficulty, chunk, start, count in index.tolist()
+            }
+        start, count = self.lookup[(*split_beatmap_id(beatmap_id), chunk)]
+        return self.tokens()[start : start + count]
+
+    def remaining(self, beatmapset_ids):
+        # Index and tokens without the given beatmapsets, for write().
+        index = self.index()
+        removed = np.isin(index["beatmapset_id"], [int(i) for i in beatmapset_ids])
+        return index[~removed], self.tokens()
+
+    def write(self, parts, vocab):
+        # Writes the (index, tokens) parts one after another and swaps them in.
+        # Every part's index points into its own tokens, runs of adjacent
+        # sequences are copied at once without looking at the ids.
+        os.makedirs(self.folder, exist_ok=True)
+        parts = [(np.asarray(index), tokens) for index, tokens in parts]
+        total = sum(int(index["count"].sum()) for index, _ in parts)
+
+        tmp_tokens_file = f"{self.tokens_file}.tmp.npy"
+        out_tokens = np.lib.format.open_memmap(
+            tmp_tokens_file, mode="w+", dtype=TOKEN_DTYPE, shape=(total,)
+        )
+        out_index = np.empty(sum(len(index) for index, _ in parts), dtype=INDEX_DTYPE)
+
+        position = row = 0
+        for index, tokens in parts:
+            starts, counts = index["start"], index["count"]
+            ends = starts + counts
+            # A run ends where the next sequence doesn't start right after it.
+            breaks = np.flatnonzero(starts[1:] != ends[:-1]) + 1
+            run_starts = np.concatenate([[0], breaks])
+            run_ends = np.concatenate([breaks, [len(index)]])
+
+            out_index[row : row + len(index)] = index
+            offsets = np.cumsum(counts) - counts + position
+            out_index["start"][row : row + len(index)] = offsets
+            for first, last in zip(run_starts.tolist(), run_ends.tolist()):
+                if first == last:
+                    continue
+                source = tokens[starts[first] : ends[last - 1]]
+                out_tokens[offsets[first] : offsets[first] + len(source)] = source
+
+            position += int(counts.sum())
+            row += len(index)
+
+        out_tokens.flush()
+        del out_tokens
+        tmp_index_file = f"{self.index_file}.tmp.npy"
+        np.save(tmp_index_file, out_index)
+        tmp_vocab_file = f"{self.vocab_file}.tmp"
+        with open(tmp_vocab_file, "w") as f:
+            json.dump({"sha256": vocab, "dtype": np.dtype(TOKEN_DTYPE).name}, f)
+
+        os.replace(tmp_tokens_file, self.tokens_file)
+        os.replace(tmp_index_file, self.index_file)
+        os.replace(tmp_vocab_file, self.vocab_file)
+        self.lookup = None
+
+    def write_parts(self, parts, vocab, kept=None):
+        # Writes the kept part of the store followed by parts as they come.
+        # Their tokens are spooled to a file first so only their index stays
+        # in memory.
+        os.makedirs(self.folder, exist_ok=True)
+        spool_file = os.path.join(self.folder, "tokens.spool")
+        indexes = [np.empty(0, dtype=INDEX_DTYPE)]
+        count = 0
+        try:
+            with open(spool_file, "wb") as f:
+                for index, tokens in parts:
+                    index = np.array(index)
+                    index["start"] += count
+                    f.write(np.ascontiguousarray(tokens, dtype=TOKEN_DTYPE).tobytes())
+                    count += len(tokens)
+                    indexes.append(index)
+
+            spooled = np.empty(0, dtype=TOKEN_DTYPE)
+            if count:
+                spooled = np.memmap(spool_file, dtype=TOKEN_DTYPE, mode="r")
+            new_part = (np.concatenate(indexes), spooled)
+            self.write([kept, new_part] if kept is not None else [new_part], vocab)
+        finally:
+            os.remove(spool_file)
+
+
+def sequences_part(sequences):
+    # (beatmap_id, chunk, token ids) sequences as an (index, tokens) part.
+    sequences = list(sequences)
+    index = np.empty(len(sequences), dtype=INDEX_DTYPE)
+    beatmaps = [split_beatmap_id(beatmap_id) for beatmap_id, _, _ in sequences]
+    counts = np.array([len(ids) for _, _, ids in sequences], dtype=np.int64)
+    index["beatmapset_id"] = [beatmapset_id for beatmapset_id, _ in beatmaps]
+    index["difficulty"] = [difficulty for _, difficulty in beatmaps]
+    index["chunk"] = [chunk for _, chunk, _ in sequences]
+    index["count"] = counts
+    index["start"] = np.cumsum(counts) - counts
+    tokens = np.concatenate(
+        [ids for _, _, ids in sequences] or [np.empty(0, dtype=TOKEN_DTYPE)]
+    ).astype(TOKEN_DTYPE)
+    return index, tokens
+
+
+# Concatenates stores into output without decoding their tokens.
+def concat_stores(stores, output):
+    vocabs = {store.vocab() for store in stores}
+    if len(vocabs) > 1:
+        raise ValueError("Token stores were encoded with different vocabularies.")
+    output.write([(store.index(), store.tokens()) for store in stores], vocabs.pop())
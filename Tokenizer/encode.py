@@ -1,10 +1,37 @@
 import argparse
 import json
 import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "Dataset", "pipeline"))
+
+from ledger import STAGE_COLUMNS, Ledger, changed_ids, table_ledger
+from mel_store import MelStore
+from schema import TABLE_COLUMNS, get_beatmapset_ids
+from storage import STORAGES, get_file_storage
+from token_store import TOKEN_DTYPE, TokenStore, sequences_part, vocab_sha256
+
+# Columns of formatted.csv the tokens are built from.
+ENCODED_COLUMNS = [
+    "id",
+    "time",
+    "type",
+    "delta_time",
+    "repeat",
+    "slider_velocity",
+    "duration",
+]
+OUTPUT_FORMATS = ["text", "binary"]
+
+# Tokenizer shared with the worker processes, see map_shards.
+tokenizer = None
+
 
 def correct_effect_value(x):
     if x > 8:
@@ -27,107 +54,139 @@ def parse_path(path):
     return ",".join(p)
 
 
-def get_delta_time(dt):
-    result = ["<start_delta_time>"]
-    m = dt // 2000
-    n = dt % 2000
-    for _ in range(m):
-        result.append("dt_2000")
-    result += ["dt_" + str(n), "<end_delta_time>"]
-    return ",".join(result)
-
-
-def get_duration(t):
-    result = ["<start_duration>"]
-    m = t // 2000
-    n = t % 2000
-    for _ in range(m):
-        result.append("duration_2000")
-    result += ["duration_" + str(n), "<end_duration>"]
-    return ",".join(result)
-
-
-def get_repeat(r):
-    result = ["<start_repeat>"]
-    m = r // 30
-    n = r % 30
-    for _ in range(m):
-        result.append("repeat_30")
-    result += ["repeat_" + str(n), "<end_repeat>"]
-    return ",".join(result)
-
-
-def encode(beatmap):
-    encoded = []
-
-    for _, row in beatmap.iterrows():
-        hit_obj_type = row["type"]
-        hit_obj = ["<hit_object_start>"]
-
-        t = "type_" + row["type"]
-        # x = f"x_{max(0, min(512, round(row["x"] / 32) * 32))}"
-        # y = f"y_{max(0, min(384, round(row["y"] / 32) * 32))}"
-        # hit_sound = f"hit_sound_{row["hit_sound"]}"
-        # new_combo = f"new_combo_{int(row["new_combo"])}"
-        # sample_set = f"sample_set_{row["sample_set"]}"
-        # volume = f"vol_{round(row["volume"] / 10) * 10}"
-        # effects = f"effects_{correct_effect_value(row["effects"])}"
-        delta_time = get_delta_time(row["delta_time"])
-
-        repeat = "<start_repeat>,repeat_0,<end_repeat>"
-        slider_velocity = "sv_0.0"
-        duration = "<start_duration>,duration_0,<end_duration>"
-
-        if hit_obj_type == "slider":
-            # path = parse_path(row["path"])
-            repeat = get_repeat(row["repeat"])
-            slider_velocity = f"sv_{round(row["slider_velocity"], 1)}"
-
-        if hit_obj_type != "circle":
-            duration = get_duration(row["duration"])
-
-        hit_obj += [t, delta_time, repeat, slider_velocity, duration]
-
-        hit_obj.append("<hit_object_end>")
-        encoded.append(",".join(hit_obj))
-    return ",".join(encoded)
+# Tokens of a hit object as slots. Every slot holds one token, the dt_2000,
+# repeat_30 and duration_2000 slots are repeated as often as the value needs.
+SLOTS = 16
+
+
+class Tokenizer:
+    def __init__(self, tok_to_id):
+        self.tok_to_id = tok_to_id
+        if max(tok_to_id.values()) > np.iinfo(TOKEN_DTYPE).max:
+            raise ValueError(f"Token ids don't fit into {np.dtype(TOKEN_DTYPE)}.")
+        self.id_to_tok = np.empty(max(tok_to_id.values()) + 1, dtype=object)
+        for token, token_id in tok_to_id.items():
+            self.id_to_tok[token_id] = token
+
+    def lookup(self, values, token):
+        # Token id of every value, the token names are only built once per
+        # distinct value. Unknown tokens raise a KeyError.
+        unique, inverse = np.unique(values, return_inverse=True)
+        ids = [self.tok_to_id[token(value)] for value in unique.tolist()]
+        return np.array(ids, dtype=TOKEN_DTYPE)[inverse.reshape(-1)]
+
+    def split(self, values, step, prefix, slots, ids, counts):
+        # value -> value // step "<prefix><step>" tokens and a "<prefix><rest>".
+        counts[:, slots[0]] = np.maximum(values // step, 0)
+        ids[:, slots[0]] = self.tok_to_id[f"{prefix}{step}"]
+        ids[:, slots[1]] = self.lookup(values % step, f"{prefix}{{}}".format)
+
+    def encode(self, beatmap):
+        # Token ids of all hit objects of a difficulty, built column by column,
+        # and the number of tokens of each hit object.
+        hit_type = beatmap["type"].to_numpy(dtype=object)
+        is_slider = hit_type == "slider"
+        is_circle = hit_type == "circle"
+
+        delta_time = beatmap["delta_time"].to_numpy(dtype=np.int64)
+        repeat = np.where(is_slider, beatmap["repeat"].to_numpy(dtype=np.int64), 0)
+        duration = np.where(is_circle, 0, beatmap["duration"].to_numpy(dtype=np.int64))
+        slider_velocity = np.where(
+            is_slider, beatmap["slider_velocity"].to_numpy(dtype=np.float64), 0.0
+        )
+
+        ids = np.empty((len(beatmap), SLOTS), dtype=TOKEN_DTYPE)
+        counts = np.ones((len(beatmap), SLOTS), dtype=np.int64)
+        for slot, token in [
+            (0, "<hit_object_start>"),
+            (2, "<start_delta_time>"),
+            (5, "<end_delta_time>"),
+            (6, "<start_repeat>"),
+            (9, "<end_repeat>"),
+            (11, "<start_duration>"),
+            (14, "<end_duration>"),
+            (15, "<hit_object_end>"),
+        ]:
+            ids[:, slot] = self.tok_to_id[token]
+        ids[:, 1] = self.lookup(hit_type, "type_{}".format)
+        self.split(delta_time, 2000, "dt_", (3, 4), ids, counts)
+        self.split(repeat, 30, "repeat_", (7, 8), ids, counts)
+        ids[:, 10] = self.lookup(slider_velocity, lambda sv: f"sv_{round(sv, 1)}")
+        self.split(duration, 2000, "duration_", (12, 13), ids, counts)
+
+        return np.repeat(ids.ravel(), counts.ravel()), counts.sum(axis=1)
+
+    def sequence(self, ids, first=False, last=False):
+        # A chunk's token ids with the beatmap markers, as stored in binary.
+        return np.concatenate(
+            [
+                [self.tok_to_id["<beatmap_start>"]] if first else [],
+                ids,
+                [self.tok_to_id["<beatmap_end>"]] if last else [],
+            ]
+        ).astype(TOKEN_DTYPE)
+
+    def tokens(self, ids, first=False, last=False):
+        # Debug view, the comma joined tokens of a chunk as encoded.csv used
+        # to hold them, beatmap markers included.
+        encoded = ",".join(self.id_to_tok[ids])
+        if first:
+            encoded = "<beatmap_start>," + encoded
+        if last:
+            encoded = encoded + ",<beatmap_end>"
+        return encoded
 
 
-def chunk_encoding(key, group, chunk_num, tok_to_id):
+def encode_chunks(group, chunk_num, tokenizer):
+    # (chunk index, hit object token ids, first, last) of every chunk that
+    # holds tokens, beatmap markers included.
     sr = 22050
     hop_length = 512
     chunk_size = 512
 
     chunk_duration = (chunk_size * hop_length) / sr  # 11.889
-    group["time_sec"] = group["time"] / 1000
+    time_sec = group["time"].to_numpy(dtype=np.float64) / 1000
+    object_chunks = (time_sec // chunk_duration).astype(int)
 
-    group["chunk_idx"] = (group["time_sec"] // chunk_duration).astype(int)
+    # Hit objects ordered by chunk, keeping their order inside a chunk, so
+    # every chunk's tokens are one slice of the difficulty's token ids.
+    inside = np.flatnonzero((object_chunks >= 0) & (object_chunks < chunk_num))
+    order = inside[np.argsort(object_chunks[inside], kind="stable")]
+    ids, counts = tokenizer.encode(group.iloc[order])
 
-    chunked_objects = group.groupby("chunk_idx")
-    dataset = []
+    token_offsets = np.concatenate([[0], np.cumsum(counts)])
+    chunk_starts = np.searchsorted(object_chunks[order], np.arange(chunk_num + 1))
+    bounds = token_offsets[chunk_starts]
 
     for chunk_idx in range(chunk_num):
-        if chunk_idx in chunked_objects.groups:
-            encoded = encode(chunked_objects.get_group(chunk_idx))
-        else:
-            encoded = ""
-
-        if chunk_idx == 0:
-            encoded = "<beatmap_start>," + encoded
-        if chunk_idx == chunk_num - 1:
-            encoded = encoded + ",<beatmap_end>"
-
-        if len(encoded):
-            dataset.append(
-                {
-                    "beatmap_id": key,
-                    "chunk": chunk_idx,
-                    # "tokenized": tokens_to_ids(encoded, tok_to_id),
-                    "tokenized": encoded,
-                }
+        chunk_ids = ids[bounds[chunk_idx] : bounds[chunk_idx + 1]]
+        first, last = chunk_idx == 0, chunk_idx == chunk_num - 1
+        if len(chunk_ids) or first or last:
+            yield chunk_idx, chunk_ids, first, last
+
+
+def chunk_encoding(key, group, chunk_num, tokenizer):
+    return pd.DataFrame(
+        [
+            {
+                "beatmap_id": key,
+                "chunk": chunk_idx,
+                "tokenized": tokenizer.tokens(chunk_ids, first, last),
+            }
+            for chunk_idx, chunk_ids, first, last in encode_chunks(
+                group, chunk_num, tokenizer
             )
+        ]
+    )
 
-    return pd.DataFrame(dataset)
+
+def chunk_sequences(key, group, chunk_num, tokenizer):
+    return [
+        (key, chunk_idx, tokenizer.sequence(chunk_ids, first, last))
+        for chunk_idx, chunk_ids, first, last in encode_chunks(
+            group, chunk_num, tokenizer
+        )
+    ]
 
 
 def tokens_to_ids(text, tok_to_id):
@@ -135,31 +194,159 @@ def tokens_to_ids(text, tok_to_id):
     return ",".join(ids)
 
 
-def process(input_file, output_file, mel_folder):
-    song_ids = os.listdir(mel_folder)
-    chunk_sizes = {}
-    for song_id in song_ids:
-        beatmapset_id = song_id.split("_")[0]
-        chunk_sizes[beatmapset_id] = chunk_sizes.get(beatmapset_id, 0) + 1
+def init_worker(shared_tokenizer):
+    global tokenizer
+    tokenizer = shared_tokenizer
+
+
+def encode_shard(shard):
+    # Encodes the beatmaps of a shard, as one table or (index, tokens) part.
+    df, chunk_nums, output_format = shard
+    grouped = df.groupby("id", observed=True)
+    encode_beatmap = chunk_sequences if output_format == "binary" else chunk_encoding
+    encoded = [
+        encode_beatmap(key, group, chunk_nums[key.split("-")[0]], tokenizer)
+        for key, group in grouped
+    ]
+
+    if output_format == "binary":
+        return sequences_part(sequence for beatmap in encoded for sequence in beatmap)
+    return pd.concat(encoded, ignore_index=True) if encoded else None
+
+
+def iter_shards(storage, table, beatmapset_ids, shard_rows):
+    # The input in shards of whole beatmapsets, at least shard_rows rows each
+    # but the last. Chunks are gathered until the beatmapsets before the last
+    # one have shard_rows rows, parquet gives a chunk per beatmapset.
+    # Formatted tables are appended song by song, so a beatmapset's rows are
+    # contiguous and only the last one gathered can continue in the next chunk.
+    keep = None if beatmapset_ids is None else set(map(str, beatmapset_ids))
+    pending = []
+    rows = 0
+    for chunk in storage.iter_chunks(
+        table, columns=ENCODED_COLUMNS, chunksize=shard_rows, typed=True
+    ):
+        if keep is not None:
+            chunk = chunk[get_beatmapset_ids(chunk, table).isin(keep)]
+        if chunk.empty:
+            continue
+        pending.append(chunk)
+        rows += len(chunk)
+        if rows < shard_rows:
+            continue
+
+        chunk = pd.concat(pending, ignore_index=True)
+        song_ids = get_beatmapset_ids(chunk, table).to_numpy()
+        others = np.flatnonzero(song_ids != song_ids[-1])
+        last_start = others[-1] + 1 if len(others) else 0
+        if last_start < shard_rows:
+            pending = [chunk]
+            continue
+        yield chunk.iloc[:last_start]
+        pending = [chunk.iloc[last_start:]]
+        rows = len(pending[0])
+
+    if pending:
+        yield pd.concat(pending, ignore_index=True)
+
+
+def map_shards(shards, workers, shared_tokenizer):
+    # Encodes shards in order. At most two shards per worker are read ahead,
+    # so memory is bounded by the shard size instead of the input size.
+    if workers <= 1:
+        init_worker(shared_tokenizer)
+        yield from map(encode_shard, shards)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=init_worker, initargs=(shared_tokenizer,)
+    ) as executor:
+        pending = deque()
+        for shard in shards:
+            pending.append(executor.submit(encode_shard, shard))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def process(
+    input_file,
+    output_file,
+    mel_folder,
+    storage="csv",
+    output_format="text",
+    workers=1,
+    shard_rows=200_000,
+):
+    mel_store = MelStore(mel_folder)
 
     dirname = os.path.dirname(__file__)
     filename = os.path.join(dirname, "vocab/token2id.json")
     with open(filename, "r") as f:
         tok_to_id = json.load(f)
+    tokenizer = Tokenizer(tok_to_id)
+    vocab = vocab_sha256(filename)
+
+    input_storage, input_table = get_file_storage(storage, input_file)
+    input_ledger = table_ledger(input_storage, input_table)
+
+    # Binary output is a token store folder, text output a table.
+    if output_format == "binary":
+        token_store = TokenStore(output_file)
+        output_ledger = Ledger(token_store.ledger_file, STAGE_COLUMNS)
+        output_exists = token_store.exists() and token_store.vocab() == vocab
+    else:
+        output_storage, output_table = get_file_storage(storage, output_file)
+        output_ledger = table_ledger(output_storage, output_table)
+        output_exists = output_storage.exists(output_table)
+
+    # With ledgers on both sides only beatmapsets formatted since the last run
+    # are encoded, their old rows and those of removed sets are dropped first.
+    beatmapset_ids = None
+    stale_ids = set()
+    if input_ledger.exists() and output_ledger.exists() and output_exists:
+        source_hashes = input_ledger.hashes()
+        target_hashes = output_ledger.hashes()
+        beatmapset_ids = changed_ids(source_hashes, target_hashes)
+        stale_ids = beatmapset_ids | (set(target_hashes) - set(source_hashes))
+        if output_format == "text":
+            output_storage.remove(output_table, stale_ids)
+
+    shards = (
+        (
+            df,
+            {
+                song_id: mel_store.chunk_count(song_id)
+                for song_id in get_beatmapset_ids(df, input_table).unique()
+            },
+            output_format,
+        )
+        for df in iter_shards(input_storage, input_table, beatmapset_ids, shard_rows)
+    )
+
+    parts = tqdm(
+        map_shards(shards, workers, tokenizer), desc="Tokenize shards", unit="shard"
+    )
+    parts = (part for part in parts if part is not None)
+
+    # Shards are written as they are encoded.
+    if output_format == "binary":
+        kept = None
+        if beatmapset_ids is not None:
+            kept = token_store.remaining(stale_ids)
+        token_store.write_parts(parts, vocab, kept)
+    else:
+        if beatmapset_ids is None:
+            output_storage.write(
+                output_table, pd.DataFrame(columns=TABLE_COLUMNS["encoded"])
+            )
+        for part in parts:
+            output_storage.append(output_table, part)
 
-    df = pd.read_csv(input_file)
-
-    grouped = df.groupby("id")
-
-    dataset = []
-
-    for key, group in tqdm(grouped, desc="Tokenize beatmaps"):
-        chunk_num = chunk_sizes[key.split("-")[0]]
-        dataset.append(chunk_encoding(key, group, chunk_num, tok_to_id))
-
-    dataset = pd.concat(dataset, ignore_index=True)
-
-    dataset.to_csv(output_file, index=False)
+    if input_ledger.exists():
+        output_ledger.entries = input_ledger.entries
+        output_ledger.compact()
 
 
 def main():
@@ -167,9 +354,37 @@ def main():
     parser.add_argument("--input_file", required=True)
     parser.add_argument("--output_file", required=True)
     parser.add_argument("--mel_folder", required=True)
+    parser.add_argument("--storage", choices=STORAGES, default="csv")
+    parser.add_argument(
+        "--output_format",
+        choices=OUTPUT_FORMATS,
+        default="text",
+        help="text: a table of comma joined tokens, binary: a token store folder "
+        "of uint16 token ids.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes encoding shards in parallel.",
+    )
+    parser.add_argument(
+        "--shard_rows",
+        type=int,
+        default=200_000,
+        help="Rows of formatted hit objects read and encoded at a time.",
+    )
     args = parser.parse_args()
 
-    process(args.input_file, args.output_file, args.mel_folder)
+    process(
+        args.input_file,
+        args.output_file,
+        args.mel_folder,
+        args.storage,
+        args.output_format,
+        args.workers,
+        args.shard_rows,
+    )
 
 
 if __name__ == "__main__":